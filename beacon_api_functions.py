@@ -3,13 +3,35 @@
 
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import datetime as dt
 import json
+import re
+import codecs
 import time
 import os.path
-from arcgis import GIS
+import random
+import statistics
 import calendar
 import configparser
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
+from gis_edits import EditBatcher
+from meter_index import MeterIndex, partition
+from records import MonthlyRead
+from export_cache import ExportCache
+from meter_stats import MeterStats
+from meter_aggregates import AggregateStore
+from change_tracker import ChangeTracker
+from checkpoint import JOURNAL_FILE, RunJournal, row_key
+from flow_ingest import flow_columns, reported_flow, table_rows
+from flow_store import FlowStore
+from leak_analytics import FlowMatrix, flagged, summarize, summary_rows
+from portal import get_connection, MODEL_ITEM, BADGER_ITEM
+from instrumentation import metrics
+from rate_limit import rate_limiter
 
 
 #configure api functions with information from a file
@@ -29,6 +51,129 @@ def next_hour(date):
     return date + dt.timedelta(hours=1)
 
 
+#columns requested for the hourly route exports and the monthly audit
+HOURLY_COLUMNS = (
+    'Account_Full_Name,Endpoint_SN,Endpoint_Type,Flow_Time,Flow,Flow_Unit,Location_Address_Line1,'
+    'Current_Leak_Rate,Current_Leak_Start_Date,Backflow_Gallons,Battery_Level'
+)
+MONTHLY_COLUMNS = (
+    'Account_Full_Name,Location_Address_Line1,Location_City,Endpoint_SN,'
+    'Flow,Flow_Time,Service_Point_Latitude,Service_Point_Longitude,SA_Start_Date,Read_Method,Account_ID'
+)
+
+
+#list of routes in the hwy 96 zone, used by collect_all when the config doesn't list any
+HWY_96_ROUTES = ['21', '26', '27', '29']
+
+
+#base class for anything that goes wrong talking to beacon
+class BeaconError(Exception):
+    pass
+
+
+#beacon answered with an error status after all the retries were used up
+class BeaconHTTPError(BeaconError):
+    def __init__(self, status_code, url, body):
+        super().__init__(f'Beacon returned {status_code} for {url}: {body[:200]}')
+        self.status_code = status_code
+        self.url = url
+        self.body = body
+
+
+#beacon answered but the body wasn't what was expected, like a string where a json object should be
+class BeaconResponseError(BeaconError):
+    def __init__(self, url, body):
+        super().__init__(f'Unexpected response from {url}: {str(body)[:200]}')
+        self.url = url
+        self.body = body
+
+
+#owns one keep alive session for all the calls to beacon. connections are pooled and reused, 429 and 5xx responses
+#are retried with backoff (honoring Retry-After), every request waits on the rate limiter and has a timeout
+class BeaconClient:
+    def __init__(self, bcon, limiter=None, timeout=(10, 120), retries=5, backoff=2.0, pool_size=10,
+                 base_url='https://api.beaconama.net'):
+        self.bcon = bcon
+        self.limiter = limiter if limiter is not None else rate_limiter(bcon)
+        self.timeout = timeout
+        self.backoff = backoff
+        self.base_url = base_url.rstrip('/')
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(['GET', 'POST']),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.auth = auth(bcon)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    #url paths are relative to the api, report urls from a status already are
+    def url(self, path):
+        return f'{self.base_url}/{path.lstrip("/")}'
+
+    #sends a request and returns the raw response, raises BeaconHTTPError if beacon still fails after retrying. the
+    #call is timed under name, waiting on the rate limiter isn't counted
+    def send(self, method, path, name='beacon', **kwargs):
+        self.limiter.acquire()
+        url = self.url(path)
+        with metrics.timer(name):
+            resp = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            if not kwargs.get('stream'):
+                metrics.add_bytes(name, len(resp.content))
+            if resp.status_code >= 400:
+                raise BeaconHTTPError(resp.status_code, url, resp.text)
+        return resp
+
+    #sends a request and loads the json body, if expect is a type the body has to be that type
+    def request(self, method, path, expect=None, name='beacon', **kwargs):
+        resp = self.send(method, path, name, **kwargs)
+        try:
+            body = json.loads(resp.content)
+        except ValueError:
+            raise BeaconResponseError(resp.url, resp.text)
+        if expect is not None and not isinstance(body, expect):
+            raise BeaconResponseError(resp.url, body)
+        return body
+
+    #posts an export request to the range api. sometimes beacon responds with a string instead of the json object with
+    #the uuid, that is retried with a growing wait instead of immediately
+    def post_export(self, params, attempts=5):
+        for attempt in range(attempts):
+            try:
+                return self.request('POST', '/v2/eds/range', expect=dict, name='beacon export',
+                                    params=params, headers=header(self.bcon))
+            except BeaconResponseError:
+                if attempt == attempts - 1:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+
+
+#one client per beacon login shared by the whole process so the connections get reused
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+#get the shared client for this beacon config, the base_url, timeout and rate limit can be set in the config file
+def beacon_client(bcon):
+    key = (bcon['username'], bcon.get('base_url', 'https://api.beaconama.net'))
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = BeaconClient(
+                bcon,
+                timeout=(10, float(bcon.get('timeout', 120))),
+                retries=int(bcon.get('retries', 5)),
+                base_url=key[1]
+            )
+        return _clients[key]
+
+
 #authorization parameters
 def auth(bcon):
     return bcon['username'], bcon['password']
@@ -40,11 +185,9 @@ def header(bcon):
 
 
 #posts a request to beacon's api to get flow data for the selected routes, returns the uuid and url to request data
-def request_service_flow(route_num, s_date, e_date, bcon):
-    #required authorization to use api
-    a = auth(bcon)
-    #required header to make a post to server
-    h = header(bcon)
+def request_service_flow(route_num, s_date, e_date, bcon, client=None):
+    if client is None:
+        client = beacon_client(bcon)
 
     #parameters needed for data
     params = {
@@ -52,49 +195,41 @@ def request_service_flow(route_num, s_date, e_date, bcon):
         'Start_Date': s_date,
         'End_Date': e_date,
         'Output_Format': 'json',
-        'Header_Columns': (
-            f'Account_Full_Name,Endpoint_SN,Endpoint_Type,Flow_Time,Flow,Flow_Unit,Location_Address_Line1,'
-            f'Current_Leak_Rate,Current_Leak_Start_Date,Backflow_Gallons,Battery_Level'
-        ),
+        'Header_Columns': HOURLY_COLUMNS,
         'Resolution': 'Hourly'
     }
 
     #post a request for data using the data range api, this gets all data between start and end
-    resp = requests.post('https://api.beaconama.net/v2/eds/range', params=params, headers=h, auth=a)
-    raw = json.loads(resp.content)
+    return client.post_export(params)
 
-    return raw
 
+#posts a request to beacon's server to get monthly flow data for all meters reported on beacon, or only the meters on
+#one route when route is passed, returns the uuid and url to request data
+def monthly_meter_audit(s_date, e_date, bcon, client=None, route=None):
+    if client is None:
+        client = beacon_client(bcon)
 
-#posts a request to beacon's server to get monthly flow data for all meters reported on beacon, returns the uuid and url
-#to request data
-def monthly_meter_audit(s_date, e_date, bcon):
     params = {
         'Start_Date': s_date,
         'End_Date': e_date,
         'Output_Format': 'json',
         'Has_Endpoint': True,
-        'Header_Columns': (
-            f'Account_Full_Name,Location_Address_Line1,Location_City,Endpoint_SN,'
-            f'Flow,Flow_Time,Service_Point_Latitude,Service_Point_Longitude,SA_Start_Date,Read_Method,Account_ID'
-        ),
+        'Header_Columns': MONTHLY_COLUMNS,
         'Resolution': 'Monthly'
     }
+    if route is not None:
+        params['Service_Point_Route'] = f'{route}'
     #post a request for data using the range api, this gets all data between the start and end dates
-    resp = requests.post('https://api.beaconama.net/v2/eds/range', params=params, headers=header(bcon), auth=auth(bcon))
-    raw = json.loads(resp.content)
-
-    return raw
+    return client.post_export(params)
 
 
 #requests the status of the processing queue for data retrieval of the passed item
-def get_flow_status(raw, bcon):
+def get_flow_status(raw, bcon, client=None):
+    if client is None:
+        client = beacon_client(bcon)
 
     #server request to get the status of processing the data request
-    resp = requests.get(f'https://api.beaconama.net/v1/eds/status/{raw["edsUUID"]}', auth=auth(bcon))
-
-    #load json into python object
-    raw_json = json.loads(resp.content)
+    raw_json = client.request('GET', f'/v1/eds/status/{raw["edsUUID"]}', name='beacon status')
 
     #if the json is just a string and not formatted like a dictionary, return this dictionary
     if isinstance(raw_json, str):
@@ -103,26 +238,92 @@ def get_flow_status(raw, bcon):
     return raw_json
 
 
-#polls the server for the status of the data retrieval, returns the completed status containing the reportURL
-def poll_status(raw, bcon):
+#raised when an export is still not done after the polling strategy's time or status check budget runs out
+class ExportTimeout(TimeoutError):
+    pass
+
+
+#beacon put the export in its exception state. it's a ValueError too since that's what the scripts used to raise
+class ExportFailed(BeaconError, ValueError):
+    pass
+
+
+#decides how long to wait between status checks. waits start short and grow by factor up to max_delay with some
+#random jitter so several exports don't check at the same moment. an export that takes longer than max_wait seconds or
+#max_attempts status checks raises ExportTimeout. the queue and run time of every export is kept in history and is used
+#to guess how long the next export of the same kind will take
+class PollStrategy:
+    def __init__(self, initial=2.0, factor=1.6, max_delay=60.0, jitter=0.2, max_wait=2 * 60 * 60, max_attempts=None):
+        self.initial = initial
+        self.factor = factor
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.max_wait = max_wait
+        self.max_attempts = max_attempts
+        self.history = []
+        self.lock = threading.Lock()
+
+    #how long an export of this kind is expected to take, the median of past exports if there are any
+    def expected(self, kind):
+        with self.lock:
+            past = [h['total'] for h in self.history if h['kind'] == kind]
+        if not past:
+            return None
+        return statistics.median(past)
+
+    #seconds to wait before the next status check, raises ExportTimeout if the budget is used up. expected is a hint in
+    #seconds for how long the export should take, for example from its size, and lets the first checks be skipped
+    def delay(self, uuid, attempt, elapsed, expected=None):
+        if elapsed >= self.max_wait or (self.max_attempts is not None and attempt >= self.max_attempts):
+            raise ExportTimeout(
+                f'Request {uuid} was not done after {elapsed:.0f} seconds and {attempt} status checks'
+            )
+
+        wait = min(self.max_delay, self.initial * self.factor ** attempt)
+        #don't bother checking until the export is most of the way to its expected time
+        if expected is not None and elapsed + wait < 0.8 * expected:
+            wait = min(self.max_delay, 0.8 * expected - elapsed)
+        wait *= 1 + random.uniform(-self.jitter, self.jitter)
+
+        return max(0.0, min(wait, self.max_wait - elapsed))
+
+    def record(self, uuid, kind, queue, run, checks):
+        with self.lock:
+            self.history.append({'uuid': uuid, 'kind': kind, 'queue': queue, 'run': run, 'total': queue + run,
+                                 'checks': checks})
+
+
+#polls the server for the status of the data retrieval, returns the completed status containing the reportURL. the
+#strategy decides how long to wait between checks, kind groups exports for its history (for example 'hourly' or
+#'monthly') and expected is an optional guess in seconds of how long the export will take
+def poll_status(raw, bcon, client=None, strategy=None, kind=None, expected=None):
+    if strategy is None:
+        strategy = PollStrategy()
+    if expected is None:
+        expected = strategy.expected(kind)
+
     #initialize state and status as none
     state = None
     status = None
+    attempt = 0
+    start = time.monotonic()
+    running = None
 
     #loop until the state is done
     while state != 'done':
         #get the status of the data acquisition
-        status = get_flow_status(raw, bcon)
+        status = get_flow_status(raw, bcon, client)
+        attempt += 1
 
         # the state is just the included state value in the server response
         state = status['state']
 
-        #if the state is either of these pause for 15 seconds then the loop will start again
-        if state == 'queue' or state == 'run':
-            time.sleep(15.0)
+        #remember when beacon started working on it so the time in queue and running can be told apart
+        if state in ('run', 'done') and running is None:
+            running = time.monotonic()
 
         #if the state throws an exception do this stuff
-        elif state == 'exception':
+        if state == 'exception':
             #define a file path where the data error log is located
             directory = 'C:/Users/chowell/WADC Dropbox/Cole Howell/PC/Documents/Beacon API/'
             file = f'{directory}beacon_data_export_errors.txt'
@@ -142,27 +343,167 @@ def poll_status(raw, bcon):
                         f'\n{status["message"]}\n\n'
                     )
             #this will stop the program entirely and will print this to console, will not show in task scheduler though
-            raise ValueError('Something went wrong with the data export!')
+            raise ExportFailed('Something went wrong with the data export!')
+
+        #still in the queue, running, or beacon answered with something unexpected, wait and check again
+        elif state != 'done':
+            time.sleep(strategy.delay(raw['edsUUID'], attempt, time.monotonic() - start, expected))
+
+    end = time.monotonic()
+    status['queue_seconds'] = running - start
+    status['run_seconds'] = end - running
+    strategy.record(raw['edsUUID'], kind, status['queue_seconds'], status['run_seconds'], attempt)
+    metrics.observe('beacon export queue', status['queue_seconds'])
+    metrics.observe('beacon export run', status['run_seconds'])
 
     return status
 
 
 #get the data report, accepts a completed status report as an argument
-def data_report(status, bcon):
-    #this gets the data report from the completed download, that status includes a url to use in get request
-    resp = requests.get(f"https://api.beaconama.net/{status['reportUrl']}", auth=auth(bcon))
+def data_report(status, bcon, client=None):
+    if client is None:
+        client = beacon_client(bcon)
 
-    #this takes the server response, that is a json, and loads it into a python dictionary
-    results = json.loads(resp.content)
+    #this gets the data report from the completed download, that status includes a url to use in get request, the
+    #server response is a json that gets loaded into a python dictionary
+    return client.request('GET', status['reportUrl'], expect=dict, name='beacon report')
 
-    return results
 
+#where the list of records starts in a report
+RESULTS_START = re.compile(r'"results"\s*:\s*\[')
 
-#function for getting all of the data I want for a day
-def collect_all(bcon):
 
-    #list of routes in the hwy 96 zone
-    routes = ['21', '26', '27', '29']
+#parses the records in a report's results list out of chunks of bytes without holding the whole report. only the
+#record being parsed is kept in memory, if one record is bigger than max_buffer characters something is wrong with the
+#report and it stops
+def iter_results(chunks, max_buffer=8 * 2 ** 20):
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf = ''
+    started = False
+    done = False
+    eof = False
+
+    while not done:
+        try:
+            buf += text.decode(next(chunks))
+        except StopIteration:
+            buf += text.decode(b'', final=True)
+            eof = True
+
+        #skip ahead to the results list, keep the end of the buffer in case the key is split between chunks
+        if not started:
+            m = RESULTS_START.search(buf)
+            if m is None:
+                if eof:
+                    raise BeaconResponseError('report', buf[:200])
+                buf = buf[-64:]
+                continue
+            buf = buf[m.end():]
+            started = True
+
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= len(buf):
+                break
+            if buf[pos] == ']':
+                done = True
+                break
+            #a record that is cut off at the end of the chunk fails to parse, wait for the next chunk to finish it
+            try:
+                record, pos = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                break
+            yield record
+        buf = buf[pos:]
+
+        if not done and (eof or len(buf) > max_buffer):
+            raise BeaconResponseError('report', buf[:200])
+
+
+#passes the chunks of a download through while adding up their size
+def counted(chunks, stats):
+    for chunk in chunks:
+        stats.bytes += len(chunk)
+        yield chunk
+
+
+#streams the data report for a completed status one record at a time. where is a function that returns True for the
+#records to keep and fields is the list of keys to keep in each record, both are applied as the records come in
+def iter_report(status, bcon, client=None, where=None, fields=None, chunk_size=2 ** 16):
+    if client is None:
+        client = beacon_client(bcon)
+
+    #the download is timed until the last record is read
+    with metrics.timer('beacon report') as stats:
+        resp = client.send('GET', status['reportUrl'], name='beacon report start', stream=True)
+        with resp:
+            for record in iter_results(counted(resp.iter_content(chunk_size), stats)):
+                stats.items += 1
+                if where is not None and not where(record):
+                    continue
+                if fields is not None:
+                    record = {f: record.get(f) for f in fields}
+                yield record
+
+
+#the export cache set up in the config file with cache_dir, or None if there isn't one
+def export_cache(bcon):
+    if 'cache_dir' not in bcon:
+        return None
+    return ExportCache(bcon['cache_dir'], dt.timedelta(hours=float(bcon.get('cache_settle_hours', 0))))
+
+
+#runs one route's export from start to finish: post the request, wait for beacon to build it and download it. where
+#filters the records as they download
+def fetch_route(r, s_time, e_time, bcon, client=None, strategy=None, where=None):
+    #post the request, the client retries until beacon answers with the uuid of the export
+    post = request_service_flow(r, s_time, e_time, bcon, client)
+
+    #after successful post, check the status of the data collection, once finished a json link to the results is
+    #returned
+    status = poll_status(post, bcon, client, strategy, 'hourly')
+
+    return list(iter_report(status, bcon, client, where=where))
+
+
+#gets one route's hourly data, only meters with the wireless endpoint type are kept. with a cache only the parts of the
+#time range that aren't on disk yet are exported
+def export_route(r, s_time, e_time, bcon, client=None, strategy=None, cache=None):
+    wireless = lambda n: n['Endpoint_Type'] == 'J'
+
+    if cache is None:
+        return fetch_route(r, s_time, e_time, bcon, client, strategy, wireless)
+
+    #the cache keeps every endpoint type so it's filtered after
+    rows = cache.get(
+        ('Hourly', r, HOURLY_COLUMNS), s_time, e_time,
+        lambda start, end: fetch_route(r, start, end, bcon, client, strategy),
+        '%Y-%m-%d %H:%M'
+    )
+    return [n for n in rows if wireless(n)]
+
+
+#function for getting all of the data I want for a day. every route is exported at the same time and each report is
+#downloaded as soon as it is ready, the client's limiter keeps the requests under beacon's rate limit
+def collect_all(bcon, routes=None, workers=None, client=None, strategy=None, cache=None):
+
+    #routes can be listed in the config file, otherwise use the hwy 96 zone
+    if routes is None:
+        routes = bcon['routes'].split(',') if 'routes' in bcon else HWY_96_ROUTES
+    routes = [r.strip() for r in routes]
+
+    if client is None:
+        client = beacon_client(bcon)
+    if strategy is None:
+        strategy = PollStrategy()
+    if cache is None:
+        cache = export_cache(bcon)
 
     #make the routes keys in an empty dictionary
     store = dict.fromkeys(routes, [])
@@ -181,224 +522,284 @@ def collect_all(bcon):
     # e_time = (dt.datetime.now() - dt.timedelta(days=1)).replace(hour=6, minute=0, second=0)
     # e_time = dt.datetime(2024, 5, 6, 11, 0, 0)
     # e_time = dt.datetime(2023, 9, 25, 7)
-    #loop through the routes in the list
-    for r in routes:
 
-        #initialize the post variable
-        post = f'{r}'
+    #each route gets its own thread, they spend almost all their time waiting on beacon
+    with ThreadPoolExecutor(max_workers=workers or len(routes)) as pool:
+        export = metrics.carry(export_route)
+        futures = {pool.submit(export, r, s_time, e_time, bcon, client, strategy, cache): r for r in routes}
 
-        #sometimes the post operation can respond with a string instead of a json object, this loops until it is a json
-        while isinstance(post, str):
-            post = request_service_flow(r, s_time, e_time, bcon)
-            # print(post)
+        #this puts the results in the appropriate route key from the dictionary as each route finishes
+        for future in as_completed(futures):
+            store[futures[future]] = future.result()
 
-        #after successful post, check the status of the data collection, once finished a json link to the results is
-        #returned
-        status = poll_status(post, bcon)
-        data = data_report(status, bcon)
+    return store
 
-        #this filters the results for only meters with this endpoint type, wireless
-        data['results'] = [n for n in data['results'] if n['Endpoint_Type'] == 'J']
 
-        #this puts the results in the appropriate route key from the dictionary
-        store[r] = data['results']
+#exports the monthly audit for a time range, the results are a generator when stream is True
+def fetch_audit(s_time, e_time, bcon, client=None, strategy=None, stream=False, route=None):
+    post = monthly_meter_audit(s_time, e_time, bcon, client, route)
+    status = poll_status(post, bcon, client, strategy, 'monthly')
+    results = iter_report(status, bcon, client)
+    if not stream:
+        results = list(results)
 
-        #pause for 10 seconds since the api is rate limited, just makes sure the program doesn't crash
-        time.sleep(10.0)
+    return results
 
-    return store
 
+#splits s_time to e_time into ranges of whole months, the first starts at s_time and the last ends at e_time
+def month_slices(s_time, e_time, months=1):
+    slices = []
+    start = s_time
+    while start <= e_time:
+        end = start.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        for _ in range(months):
+            end = (end + dt.timedelta(days=32)).replace(day=1)
+        end = min(end - dt.timedelta(seconds=1), e_time)
+        slices.append((start, end))
+        start = end + dt.timedelta(seconds=1)
+
+    return slices
+
+
+#the monthly audit as several smaller exports, one per range of slice_months months and route in routes (routes None is
+#every meter). the slices are exported at the same time with the client's limiter keeping the posts under beacon's rate
+#limit and the slices that fail are tried again up to attempts times, the ones that worked are kept. records are merged
+#on Endpoint_SN and Flow_Time so a meter that moved routes during the window is only counted once
+def sliced_audit(s_time, e_time, bcon, client=None, strategy=None, slice_months=None, routes=None, workers=None,
+                 attempts=3):
+    if client is None:
+        client = beacon_client(bcon)
+    if strategy is None:
+        strategy = PollStrategy()
+
+    ranges = month_slices(s_time, e_time, slice_months) if slice_months else [(s_time, e_time)]
+    slices = [(start, end, r) for start, end in ranges for r in (routes or [None])]
+
+    done = {}
+    for attempt in range(attempts):
+        failed = {}
+        with ThreadPoolExecutor(max_workers=workers or len(slices)) as pool:
+            fetch = metrics.carry(fetch_audit)
+            futures = {pool.submit(fetch, start, end, bcon, client, strategy, False, r): (start, end, r)
+                       for start, end, r in slices}
+            for future in as_completed(futures):
+                try:
+                    done[futures[future]] = future.result()
+                except (BeaconError, ExportTimeout, requests.RequestException) as e:
+                    failed[futures[future]] = e
+
+        #only the slices that failed are exported again
+        slices = list(failed)
+        if not slices:
+            break
+    else:
+        raise list(failed.values())[0]
+
+    records = {}
+    for key in sorted(done, key=lambda k: (k[0], k[2] or '')):
+        for n in done[key]:
+            records[(n.get('Endpoint_SN'), n.get('Flow_Time')) if n.get('Endpoint_SN') is not None else id(n)] = n
 
-#function for performing the monthly audit, gets data from 2 months ago that was read last month
-def monthly_audit(s_time, e_time, bcon):
+    return list(records.values())
+
+
+#function for performing the monthly audit, gets data from 2 months ago that was read last month. when stream is True
+#the first item is a generator that reads the report as it downloads instead of a list. with a cache only the months
+#that aren't on disk yet are exported, and the results are always a list. the export can be split into slices of
+#slice_months months and/or one per route (audit_slice_months and audit_routes in the config file), the results are
+#then always a list too
+def monthly_audit(s_time, e_time, bcon, client=None, strategy=None, stream=False, cache=None, slice_months=None,
+                  routes=None):
     # current_month = dt.datetime.now().replace(day=1, hour=0, minute=0, second=0)
     # last_month = (current_month - dt.timedelta(days=1)).replace(day=1)
     # s_time = current_month.replace(month=current_month.month-2, day=1, hour=0, minute=0, second=0)
     # e_time = (last_month - dt.timedelta(days=1)).replace(hour=23, minute=59, second=59)
 
-    post = monthly_meter_audit(s_time, e_time, bcon)
-    status = poll_status(post, bcon)
-    data = data_report(status, bcon)
+    if cache is None:
+        cache = export_cache(bcon)
+    if slice_months is None and 'audit_slice_months' in bcon:
+        slice_months = int(bcon['audit_slice_months'])
+    if routes is None and 'audit_routes' in bcon:
+        routes = [r.strip() for r in bcon['audit_routes'].split(',')]
+
+    if slice_months or routes:
+        fetch = lambda start, end: sliced_audit(start, end, bcon, client, strategy, slice_months, routes)
+    else:
+        fetch = lambda start, end: fetch_audit(start, end, bcon, client, strategy, cache is None and stream)
+
+    if cache is None:
+        results = fetch(s_time, e_time)
+    else:
+        #sliced exports are cached under the routes they cover so they aren't mixed with whole territory exports
+        results = cache.get(
+            ('Monthly', ','.join(routes) if routes else 'all', MONTHLY_COLUMNS), s_time, e_time, fetch, '%Y-%m'
+        )
+
+    return [results, s_time, e_time]
+
+
+#the monthly audit's records as a generator. nothing is exported until the first record is asked for, so the export,
+#the wait and the download all happen in the thread reading it, like the first stage of a pipeline
+def audit_records(s_time, e_time, bcon, client=None, strategy=None):
+    yield from monthly_audit(s_time, e_time, bcon, client, strategy, stream=True)[0]
 
-    return [data['results'], s_time, e_time]
 
+#the local hourly flow store named by flow_store in the config file, or None if there isn't one
+def flow_store(g):
+    if 'flow_store' not in g:
+        return None
+    return FlowStore(g['flow_store'])
 
-#function to store meter data in gis, accepts the data dictionary as an argument
-def store_in_gis(store, g):
+
+#function to store meter data in gis, accepts the data dictionary as an argument. the records are converted to typed
+#columns in one pass and added to the table chunk_size rows per call, and to the local flow store if there is one.
+#returns the number of rows, how long it took, the rows per second and the chunks that had failures
+def store_in_gis(store, g, chunk_size=2000, flows=None):
+    if flows is None:
+        flows = flow_store(g)
 
     #access the badger meter table in gis
-    gis = GIS("https://esriapps1.esriwadc.com/portal", g['username'], g['password'])
-    meter_layer = gis.content.get('62e76f6d62d543c0ad5c4954e2156efd')
-    data_table = meter_layer.tables[0]
-
-    #loop through the data dictionary that was passed in
-    for s in store:
-        # the dictionary stores data as a list of dictionaries so this loops through the list and accesses those keys
-        for i in store[s]:
-            # print(i)
-            flow = i['Flow']
-            leak_rate = i['Current_Leak_Rate']
-            backflow = i['Backflow_Gallons']
-            leak_date = i['Current_Leak_Start_Date']
-            flow_time = i['Flow_Time']
-
-            #check these values for whether they're None and if they are change their value, otherwise convert them
-            if flow is None:
-                flow = 0.0
-            else:
-                flow = float(flow)
-            if leak_rate is None:
-                leak_rate = 0.0
-            else:
-                leak_rate = float(leak_rate)
-            if backflow is None:
-                backflow = 0.0
-            else:
-                backflow = float(backflow)
-
-            #if these are not none they need to be converted to a unix timestamp since that's how gis stores them
-            if leak_date is not None:
-                leak_date = dt.datetime.strptime(i['Current_Leak_Start_Date'], '%Y-%m-%d %H:%M')
-                leak_date = dt.datetime.timestamp(leak_date) * 10**3
-
-            if flow_time is not None:
-                f_time = dt.datetime.strptime(i['Flow_Time'], '%Y-%m-%d %H:%M').replace(minute=0)
-                flow_time = dt.datetime.timestamp(f_time)*10**3
-
-                #uncomment to only record uncaptured data in event of program failure
-                # table_fset = data_table.query(
-                #     where=f"flow_time=TIMESTAMP '{f_time}' AND endpoint_sn = '{i['Endpoint_SN']}'")
-                # if table_fset.features:
-                #     continue
-
-
-            #portal compatible dictionary used to add new data to the accessed data table
-            add = {'attributes':
-                       {
-                           'account_full_name': i['Account_Full_Name'],
-                           'endpoint_sn': i['Endpoint_SN'],
-                           'endpoint_type': i['Endpoint_Type'],
-                           'flow': flow,
-                           'flow_unit': i['Flow_Unit'],
-                           'location_address_line1': i['Location_Address_Line1'],
-                           'current_leak_rate': leak_rate,
-                           'current_leak_start_date': leak_date,
-                           'backflow_gallons': backflow,
-                           'battery_level': i['Battery_Level'],
-                           'service_point_route': int(s),
-                           'flow_time': flow_time
-                       }
-                   }
-            #this function edits the feature class or data table, specifically adding the value in the list
-            #you MUST put the value you're adding inside brackets or else it throws an error
-            data_table.edit_features(adds=[add])
-
-
-#general method to access the model in gis
-def access_model(g):
-    # access the portal gis
-    gis = GIS("https://esriapps1.esriwadc.com/portal", g['username'], g['password'])
-    model_layer = gis.content.get('bba03d3af8b849848a9691b9042598be')
+    data_table = get_connection(g).table(BADGER_ITEM)
+
+    start = time.perf_counter()
+
+    #None values become 0 and the leak start and flow times become unix timestamps the way gis stores them
+    columns = flow_columns(store)
+    rows = table_rows(columns)
+    if flows is not None:
+        with metrics.timer('flow store ingest') as stats:
+            stats.items += len(rows)
+            #the flow column has 0 for hours beacon didn't report, the store only takes the real reads
+            flows.ingest(columns, reported_flow(store))
+
+    #uncomment to only record uncaptured data in event of program failure
+    # captured = {(r.attributes['endpoint_sn'], r.attributes['flow_time'])
+    #             for r in query_all(data_table, 'endpoint_sn,flow_time', where=f"flow_time >= TIMESTAMP '{s_time}'")}
+    # rows = [r for r in rows if (r['attributes']['endpoint_sn'], r['attributes']['flow_time']) not in captured]
+
+    edits = EditBatcher(data_table, chunk_size)
+    edits.edit_features(adds=rows)
+    failures = edits.flush()
+
+    seconds = time.perf_counter() - start
+    return {
+        'rows': len(rows),
+        'seconds': seconds,
+        'rows_per_second': len(rows) / seconds if seconds else 0.0,
+        'calls': edits.calls,
+        'failures': failures
+    }
+
+
+#works out a leak, backflow and battery summary for each meter over the hourly route data from collect_all and adds it
+#to the summary table named by leak_summary_item in the config file, one row per meter instead of one per hour. only
+#the meters with something to report are written unless flagged_only is False. returns the number of meters, the summary
+#rows, how long the analysis took and the chunks that had failures
+def store_leak_summary(store, g, chunk_size=1000, flagged_only=True):
+    start = time.perf_counter()
+    with metrics.timer('leak analytics') as stats:
+        matrix = FlowMatrix.from_columns(flow_columns(store))
+        summary = summarize(matrix)
+        rows = summary_rows(summary, flagged(summary) if flagged_only else None, *matrix.window())
+        stats.items += len(matrix.sns)
+    seconds = time.perf_counter() - start
+
+    failures = []
+    if 'leak_summary_item' in g:
+        edits = EditBatcher(get_connection(g).table(g['leak_summary_item']), chunk_size)
+        edits.edit_features(adds=rows)
+        failures = edits.flush()
 
+    return {'meters': len(matrix.sns), 'rows': rows, 'seconds': seconds, 'failures': failures}
+
+
+#general method to access the model in gis. the login and the item lookup are shared by every function in the run,
+#pass a connection to use a different one
+def access_model(g, connection=None):
+    # access the portal gis
+    if connection is None:
+        connection = get_connection(g)
+    model_layer = connection.item(MODEL_ITEM)
 
     # individual feature services contained in the hosted layer. There is one feature layer and one table
-    geometry_layer = model_layer.layers[0]
-    table_layer = model_layer.tables[0]
-
-    return geometry_layer, table_layer, model_layer, gis
-
-
-#general function to add a new point to the water meter model
-def build_site(d, geometry_layer, table_layer):
-    # conditional statements to check for null values and to convert the strings in the server response to their
-    # appropriate data types
-    try:
-        flow = float(d['Flow'])
-    except (ValueError, TypeError):
-        flow = 0
-    try:
-        flow_time = dt.datetime.strptime(d['Flow_Time'], '%Y-%m')
-    except (ValueError, TypeError):
-        flow_time = None
-    try:
-        sn = int(d['Endpoint_SN'])
-    except (ValueError, TypeError):
-        sn = None
+    geometry_layer = connection.layer(MODEL_ITEM)
+    table_layer = connection.table(MODEL_ITEM)
+
+    return geometry_layer, table_layer, model_layer, connection.gis
+
+
+#general function to add a new point to the water meter model. flows is the journal batch that refuses a second flow
+#table row for the same meter and month
+def build_site(d, geometry_layer, table_layer, flows=None):
+    #the beacon row's values are converted once when it's parsed into a record
+    if not isinstance(d, MonthlyRead):
+        d = MonthlyRead.parse(d)
 
     # feature datastructure, includes attribute and geometry fields for water meters. spatial reference is
     # the geographic coordinate system well-known identifier for TN state plane
-    if flow_time is not None:
+    if d.flow_time is not None:
         geo = {'attributes': {
-            'account_full_name': d['Account_Full_Name'],
-            'account_id': d['Account_ID'],
-            'endpoint_sn': sn,
-            'location_address': d['Location_Address_Line1'],
-            'location_city': d['Location_City'],
-            'sa_start_date': dt.datetime.strptime(d['SA_Start_Date'], '%Y-%m'),
-            'read_method': d['Read_Method'],
-            f'{(calendar.month_name[flow_time.month])}_gpm'.lower(): flow/(30.437*24*60)
+            'account_full_name': d.account_full_name,
+            'account_id': d.account_id,
+            'endpoint_sn': d.sn,
+            'location_address': d.address,
+            'location_city': d.city,
+            'sa_start_date': d.sa_start_date,
+            'read_method': d.read_method,
+            d.month_field: d.gpm
         },
             'geometry': {
-                'x': float(d['Service_Point_Longitude']),
-                'y': float(d['Service_Point_Latitude']),
+                'x': d.longitude,
+                'y': d.latitude,
                 'spatialReference': {'wkid': 6318}
             }
         }
         # table that stores the flow data, data is linked to geometry via the endpoint serial number
         table = {'attributes': {
-            'endpoint_sn': sn,
-            'flow': flow,
-            'flow_time': flow_time
+            'endpoint_sn': d.sn,
+            'flow': d.flow,
+            'flow_time': d.flow_time
         }
         }
-        # adds the datapoints to the feature layer
+        # adds the datapoints to the feature layer. when the layers are edit batchers the location is corrected to
+        # be in line with the master layer before the add, so there is no query and update round trip afterwards
         geometry_layer.edit_features(adds=[geo])
-        table_layer.edit_features(adds=[table])
+        if flows is None or flows.claim(d, table):
+            table_layer.edit_features(adds=[table])
+
+        return geo
+
 
-        #correct the location to be in line with master layer, I found the difference in this data and the master was
-        #basically the same for all the points so I took the difference in x and y and applied it to the geometry.
-        #it seems to make the meters line up correctly so I will use this
-        fset = geometry_layer.query(where=f'endpoint_sn = {sn}')
-        f = fset.features
-        f[0].geometry['x'] += 1.490687
-        f[0].geometry['y'] += -2.50416324
-        geometry_layer.edit_features(updates=[f[0]])
-
-
-#edit the site attributes and add the table entry
-def edit_site(d, geometry_layer, table_layer, feature):
-    # conditional statements to check for null values and to convert the strings in the server response to their
-    # appropriate data types
-    try:
-        flow = float(d['Flow'])
-    except (ValueError, TypeError):
-        flow = 0
-    try:
-        flow_time = dt.datetime.strptime(d['Flow_Time'], '%Y-%m')
-        #unclear if this will work, this is just one idea to fix the problem
-        feature.attributes[f'{calendar.month_name[flow_time.month]}_gpm'.lower()] = flow / (30.437 * 24 * 60)
-    except (ValueError, TypeError):
-        flow_time = None
-    try:
-        sn = int(d['Endpoint_SN'])
-    except (ValueError, TypeError):
-        sn = None
+#edit the site attributes and add the table entry. with a change tracker only the month's value is sent for meters
+#whose account attributes are the same as last run, with a journal batch as flows the table entry is only added if it
+#isn't there already
+def edit_site(d, geometry_layer, table_layer, feature, tracker=None, flows=None):
+    #the beacon row's values are converted once when it's parsed into a record
+    if not isinstance(d, MonthlyRead):
+        d = MonthlyRead.parse(d)
+    #unclear if this will work, this is just one idea to fix the problem
+    month = {d.month_field: d.gpm} if d.flow_time is not None else {}
 
     # feature datastructure, includes attribute and geometry fields for water meters. spatial reference is
     # the geographic coordinate system well-known identifier for TN state plane
 
-    feature.attributes['account_full_name'] = d['Account_Full_Name']
-    feature.attributes['account_id'] = d['Account_ID']
-    feature.attributes['endpoint_sn'] = sn
-    feature.attributes['location_address'] = d['Location_Address_Line1']
-    feature.attributes['location_city'] = d['Location_City']
-    feature.attributes['sa_start_date'] = dt.datetime.strptime(d['SA_Start_Date'], '%Y-%m')
+    site = {
+        'account_full_name': d.account_full_name,
+        'account_id': d.account_id,
+        'endpoint_sn': d.sn,
+        'location_address': d.address,
+        'location_city': d.city,
+        'sa_start_date': d.sa_start_date
+    }
 
     #changes the read method to reflect whether flow was detected there or not
-    if flow == 0:
-        feature.attributes['read_method'] = f'Inactive-{d["Read_Method"]}'
+    if d.flow == 0:
+        site['read_method'] = f'Inactive-{d.read_method}'
     else:
-        feature.attributes['read_method'] = d['Read_Method']
+        site['read_method'] = d.read_method
+
+    feature.attributes.update(month)
+    feature.attributes.update(site)
 
     #this is supposed to check if flow_time is null and enter data into the appropriate field if it's not
     #this does not work consistently, approximately 450 records did not record as intended for September
@@ -407,82 +808,101 @@ def edit_site(d, geometry_layer, table_layer, feature):
 
     # table that stores the flow data, data is linked to geometry via the endpoint serial number
     table = {'attributes': {
-        'endpoint_sn': sn,
-        'flow': flow,
-        'flow_time': flow_time
+        'endpoint_sn': d.sn,
+        'flow': d.flow,
+        'flow_time': d.flow_time
     }
     }
-    # edits the fields in the feature layer and adds data to the table
-    geometry_layer.edit_features(updates=[feature])
-    table_layer.edit_features(adds=[table])
+    # edits the fields in the feature layer and adds data to the table. a meter without an objectid was built this
+    # run and the edits above are already part of its add
+    oid = feature.attributes.get('objectid')
+    if tracker is None or oid is None:
+        geometry_layer.edit_features(updates=[feature])
+    else:
+        update = {'objectid': oid}
+        update.update(month)
+        if tracker.check(oid, site):
+            update.update(site)
+        if len(update) > 1:
+            geometry_layer.edit_features(updates=[{'attributes': update}])
+    if flows is None or flows.claim(d, table):
+        table_layer.edit_features(adds=[table])
 
 
-#calculate the monthly average gpm for data already entered
-def monthly_average(gps):
-    g, t, i, gis = access_model(gps)
-    fset = g.query()
-    feat = fset.features
+#the journal of the monthly update named by journal_file in the GIS config, it's kept on disk by default so a run
+#that stops partway, or the march archive, isn't done again
+def run_journal(gps):
+    return RunJournal(gps.get('journal_file', JOURNAL_FILE))
 
-    for f in feat:
-        table = g.query_related_records(object_ids=f'{f.attributes["objectid"]}', relationship_id='0')
-        # print(table)
-        for tab in table['relatedRecordGroups'][0]['relatedRecords']:
-            try:
-                date = dt.datetime.fromtimestamp(tab['attributes']['flow_time']*10**-3).month
-            except TypeError:
-                continue
-            # print(calendar.month_name[date])
-            # print(tab['attributes']['flow']/(30.437*24*60))
-            f.attributes[f'{calendar.month_name[date]}_gpm'.lower()] = tab['attributes']['flow']/(30.437*24*60)
-        g.edit_features(updates=[f])
+
+#the local store of monthly values named by aggregates_file in the GIS config, or None if there isn't one
+def aggregate_store(gps):
+    if 'aggregates_file' not in gps:
+        return None
+    return AggregateStore(gps['aggregates_file'])
 
 
-#calculate the water metering site's aggregated averages per Michael's request
-def averages(gps):
+#calculate the monthly average gpm for data already entered. the meter layer and the flow table are each loaded with
+#one paged query and only the meters whose values changed are updated. months that still don't have a value are worked
+#out from the local hourly flow store if there is one. the changed meters are also marked in the aggregate store so
+#averages picks them up
+def monthly_average(gps, chunk_size=1000, aggregates=None, flows=None):
+    g, t, i, gis = access_model(gps)
+    if aggregates is None:
+        aggregates = aggregate_store(gps)
+    if flows is None:
+        flows = flow_store(gps)
+
+    stats = MeterStats.load(g)
+    stats.apply_flow_table(t)
+    if flows is not None:
+        #newest first so a month is filled from the latest year that has it
+        for month in reversed(flows.months()):
+            stats.fill_month(int(month[5:]), flows.monthly_gpm(month))
+    if aggregates is not None:
+        dirty = stats.changed_months()
+        aggregates.replace(stats.oids[dirty], stats.months[dirty])
+
+    return stats.write(g, chunk_size, stat_values=False)
+
+
+#calculate the water metering site's aggregated averages per Michael's request. without an aggregate store the whole
+#layer is calculated at once and only the meters whose averages changed are updated. with one only the meters that got
+#a new monthly value since the last run are calculated and sent, the first run loads the layer to fill the store
+def averages(gps, chunk_size=1000, aggregates=None):
     g, t, it, gis = access_model(gps)
-    fset = g.query()
-    feat = fset.features
-
-    for f in feat:
-        count_annual = 0
-        count_summer = 0
-        sum_annual = 0
-        sum_summer = 0
-        peak = 0
-        #loop through the months
-        for i, m in enumerate(calendar.month_name):
-            if i == 0:
-                continue
-            #if the month is empty, skip it in the average
-            if f.attributes[f'{m}_gpm'.lower()] is None:
-                count_annual += 1
-                if 7 <= i <= 9:
-                    count_summer += 1
-            else:
-                sum_annual += f.attributes[f'{m}_gpm'.lower()]
-                if f.attributes[f'{m}_gpm'.lower()] > peak:
-                    peak = f.attributes[f'{m}_gpm'.lower()]
-                if 7 <= i <= 9:
-                    sum_summer += f.attributes[f'{m}_gpm'.lower()]
-        try:
-            avg_annual = sum_annual/(12-count_annual)
-            avg_summer = sum_summer/(3-count_summer)
-        except ZeroDivisionError:
-            avg_summer = 0
-            avg_annual = 0
+    if aggregates is None:
+        aggregates = aggregate_store(gps)
 
-        f.attributes['annual_avg'] = avg_annual
-        f.attributes['summer_flow'] = avg_summer
-        f.attributes['peak_flow'] = peak
-        g.edit_features(updates=[f])
+    if aggregates is None or not aggregates.seeded:
+        stats = MeterStats.load(g)
+        if aggregates is not None:
+            aggregates.seed(stats.oids, stats.months)
+        stats.calculate()
+        return stats.write(g, chunk_size, month_values=False)
+
+    oids, months = aggregates.touched()
+    stats = MeterStats.from_months(oids, months)
+    stats.calculate()
+    failures = stats.write(g, chunk_size, month_values=False)
+
+    #meters whose averages didn't make it stay touched for the next run
+    failed = {f['attributes'].get('objectid') for failure in failures for f in failure['features']}
+    aggregates.clear([o for o in oids.tolist() if o not in failed])
+    return failures
 
 
 #function used to build the meter section of the water model in the gis
-def build_model(data, gis):
+def build_model(data, gis, chunk_size=1000):
     geometry_layer, table_layer, i, g = access_model(gis)
 
+    geo_edits = EditBatcher(geometry_layer, chunk_size, correct_geometry=True)
+    table_edits = EditBatcher(table_layer, chunk_size)
+
     for d in data[0]:
-        build_site(d, geometry_layer, table_layer)
+        build_site(d, geo_edits, table_edits)
+
+    return geo_edits.flush() + table_edits.flush()
 
 
 #resets the model values to None in the master model
@@ -497,49 +917,172 @@ def reset_model(geometry_layer, feature):
     geometry_layer.edit_features(updates=[feature])
 
 
-#function to update the water model now that it has been built, now include current month as argument to reset model
-def update_model(data, current_month, gps):
-    geometry_layer, table_layer, item, gis = access_model(gps)
-
-    #before updating the water model, we want to archive the data we currently have
-    if current_month == 3:
+#function to update the water model now that it has been built, now include current month as argument to reset model.
+#edits are collected and sent in chunks of chunk_size. meters whose account attributes haven't changed since the last
+#run only get their monthly value written, the hashes are kept in the file named by delta_file in the GIS config.
+#every chunk_size rows the edits are sent and the rows are recorded in the journal from run_journal, so a rerun
+#after a crash skips the rows that are done and never adds a flow row twice. with more than one worker (update_workers
+#in the GIS config) the rows are split into shards that are updated at the same time, each on its own portal login,
+#with the portal calls kept under rate_limit per second if it's set. the month values written are kept in the aggregate
+#store (aggregates_file in the GIS config) if there is one so averages only has to redo those meters. returns the
+#chunks that had failures, the number of new, changed, unchanged and skipped meters and any shards that stopped with an
+#error. archive False skips the march archive, like when old months are loaded again
+def update_model(data, current_month, gps, chunk_size=1000, page_size=2000, tracker=None, journal=None, workers=None,
+                 aggregates=None, archive=True):
+    connection = get_connection(gps)
+    geometry_layer, table_layer, item, gis = access_model(gps, connection)
+
+    if tracker is None:
+        tracker = ChangeTracker(gps.get('delta_file'))
+    if journal is None:
+        journal = run_journal(gps)
+    if workers is None:
+        workers = int(gps.get('update_workers', 1))
+    if aggregates is None:
+        aggregates = aggregate_store(gps)
+    limiter = rate_limiter(gps) if 'rate_limit' in gps else None
+
+    #the period is the month of data being loaded
+    period = f'{data[1]:%Y-%m}'
+    done = journal.processed(period)
+    #every row is parsed into a typed record once, then the ones already done by an earlier run of this period are
+    #skipped. the rows are read as they're needed so they can still be arriving from a pipeline
+    skipped = 0
+
+    def pending():
+        nonlocal skipped
+        for d in data[0]:
+            if not isinstance(d, MonthlyRead):
+                d = MonthlyRead.parse(d)
+            #a row that's already done still keeps its meter from being matched to another row by location
+            if index.grid is not None:
+                index.claim([d])
+            if row_key(d.sn, d.address) in done:
+                skipped += 1
+                continue
+            yield d
+
+    rows = pending()
+
+    #load the meter layer once, rows are matched against this instead of querying the portal for each one. with
+    #match_tolerance in the GIS config (in the layer's units) the meter locations are loaded too
+    tolerance = float(gps['match_tolerance']) if 'match_tolerance' in gps else None
+    index = MeterIndex.load(geometry_layer, page_size=page_size, tolerance=tolerance)
+    #the location match needs every row in first, a meter that some row matches by serial number or address is never
+    #given to another row by location
+    if index.grid is not None:
+        rows = list(rows)
+
+    #before updating the water model, we want to archive the data we currently have, only once a year. this happens
+    #before any shard starts so the archive is the model as it was last month
+    if archive and current_month.month == 3 and not journal.step_done('archive', f'{current_month.year}'):
         #clone the current water model
-        clone = gis.content.clone_items(items=[item], owner='wadc_engr03', folder='water_model_data')
+        clone = gis.content.clone_items(items=[item], owner='wadc_engr03', folder='water_model_data')[0]
         #update the title
         clone.update(item_properties={'title': f'Water Meter Model {current_month.year - 1}'})
         #shares the archived data with the archived water meter data group
         clone.share(groups=['f31fd74a860249cababe86578a48f536'])
+        journal.mark_step('archive', f'{current_month.year}')
 
-    #loop through the data dictionary
-    for d in data[0]:
-        # service_start = dt.datetime.strptime(d['SA_Start_Date'], '%Y-%m')
-        #if there is no serial number in the data row then the where clause is this
-        if d['Endpoint_SN'] is None:
-            where_clause = "location_address = '{}'".format(d['Location_Address_Line1'])
-        else:
-            #format the serial number and address
-            sn = int(d['Endpoint_SN'])
-            if "'" in d['Location_Address_Line1']:
-                address = d['Location_Address_Line1'].replace("'", "''")
+    def run_shard(shard, shard_connection):
+        layers = access_model(gps, shard_connection)[:2]
+        return update_shard(shard, current_month, layers, index, tracker, journal, period, chunk_size, limiter,
+                            aggregates)
+
+    failures = []
+    errors = []
+    if workers <= 1:
+        failures += run_shard(rows, connection)
+    else:
+        #the shards can only be split once every row is in
+        rows = list(rows)
+        shards = partition(rows, index, workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(metrics.carry(run_shard), shard, get_connection(gps, shared=False)): n
+                       for n, shard in enumerate(shards) if shard}
+            for future in as_completed(futures):
+                n = futures[future]
+                try:
+                    failures += future.result()
+                except Exception as e:
+                    #the rows this shard didn't get to aren't in the journal so the next run picks them up
+                    errors.append({'shard': n, 'rows': len(shards[n]), 'error': repr(e)})
+
+    counts = dict(tracker.counts, skipped=skipped)
+    return {'failures': failures, 'meters': counts, 'errors': errors}
+
+
+#update the model with one shard of the rows, each shard has its own batchers and journal batch so its checkpoints
+#don't wait on the other shards. returns the chunks that had failures
+def update_shard(rows, current_month, layers, index, tracker, journal, period, chunk_size, limiter=None,
+                 aggregates=None):
+    geometry_layer, table_layer = layers
+    batch = journal.batch(period)
+
+    #new meters are moved onto the master layer when their chunk is sent
+    geo_edits = EditBatcher(geometry_layer, chunk_size, correct_geometry=True, limiter=limiter)
+    table_edits = EditBatcher(table_layer, chunk_size, limiter=limiter)
+
+    #the month values written since the last checkpoint as (attributes, month field, gpm, reset), they go in the
+    #aggregate store once the meters have objectids
+    months = []
+
+    #sends everything waiting and records the rows that made it in the journal. each batcher's failures are counted
+    #separately since a new failure from one of them doesn't land after the old ones from the other
+    geo_sent = 0
+    table_sent = 0
+
+    def checkpoint():
+        nonlocal geo_sent, table_sent, months
+        geo_edits.flush()
+        table_edits.flush()
+        new = geo_edits.failures[geo_sent:] + table_edits.failures[table_sent:]
+        geo_sent = len(geo_edits.failures)
+        table_sent = len(table_edits.failures)
+        journal.commit(batch, new)
+        if aggregates is not None:
+            failed = {f['attributes'].get('objectid') for failure in new for f in failure['features']}
+            aggregates.record([(a['objectid'], field, gpm, reset) for a, field, gpm, reset in months
+                               if a.get('objectid') is not None and a['objectid'] not in failed])
+            months = []
+        #keep the hashes of the meters that made it to the portal for next month
+        tracker.forget(geo_edits.failures + table_edits.failures)
+        tracker.save()
+
+    #loop through the data dictionary a chunk at a time, the service points of the rows in a chunk that might need the
+    #location match are projected together
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+
+        for d, point in zip(chunk, index.positions(chunk)):
+            key = row_key(d.sn, d.address)
+
+            #same match as the old where clause, location_address = address OR endpoint_sn = sn. with a tolerance a
+            #row that matches neither is matched to the meter at its service point
+            feature = index.match(d.address, d.sn, point)
+
+            #if there is no match then that means there isn't a site with these properties so it makes a new one
+            if feature is None:
+                # print(d)
+                site = build_site(d, geo_edits, table_edits, batch)
+                #remember the new site so another row for the same meter doesn't build it twice
+                if site is not None:
+                    index.add_created(site)
+                    tracker.add(site['attributes'])
+                    months.append((site['attributes'], d.month_field, d.gpm, True))
+                batch.mark(key)
+            #otherwise the site that is returned is edited and the edits are reflected in the hosted feature layer
             else:
-                address = d['Location_Address_Line1']
-
-            #this could probably be a f-string but I was having trouble so I did this old way of making
-            #dynamic strings
-
-            #this where clause is used for the sql query to get features that match these conditions
-            where_clause = "location_address = '{}' OR endpoint_sn = {}".format(address, sn)
-
-        geo_fset = geometry_layer.query(where=where_clause)
-        features = geo_fset.features
-
-        #if the query returns nothing then that means there isn't a site with these properties so it makes a new one
-        if not features:
-            # print(d)
-            build_site(d, geometry_layer, table_layer)
-        #otherwise the site that is returned is edited and the edits are reflected in the hosted feature layer
-        else:
-            if current_month.month == 3:
-                reset_model(geometry_layer, features[0])
-            # print(features)
-            edit_site(d, geometry_layer, table_layer, features[0])
+                if current_month.month == 3:
+                    reset_model(geo_edits, feature)
+                # print(features)
+                edit_site(d, geo_edits, table_edits, feature, tracker, batch)
+                months.append((feature.attributes, d.month_field, d.gpm, current_month.month == 3))
+                index.reindex(feature)
+                batch.mark(key, feature.attributes.get('objectid'))
+
+        checkpoint()
+    return geo_edits.failures + table_edits.failures
@@ -0,0 +1,212 @@
+#Purpose: Local stand in for beacon's export api so the data collection can be run and timed without the real service
+
+
+import datetime as dt
+import json
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+#synthetic value for one header column of one meter's record
+def synthetic_value(column, meter, route, when, resolution):
+    if column == 'Endpoint_SN':
+        return str(100000000 + meter)
+    if column == 'Account_ID':
+        return str(500000 + meter)
+    if column == 'Account_Full_Name':
+        return f'Customer {meter}'
+    if column == 'Location_Address_Line1':
+        return f'{100 + meter % 9000} Route {route} Rd'
+    if column == 'Location_City':
+        return 'Franklin'
+    if column == 'Endpoint_Type':
+        return 'J' if meter % 10 else 'R'
+    if column == 'Flow':
+        #a few meters have steady night flow, like a leak
+        base = 2.0 if meter % 50 == 0 else 0.0
+        return f'{base + (meter * 7 + when.hour * 13) % 40 / 4:.2f}' if resolution == 'Hourly' else f'{1000 + meter % 5000}'
+    if column == 'Flow_Unit':
+        return 'Gallons'
+    if column == 'Flow_Time':
+        return when.strftime('%Y-%m-%d %H:%M') if resolution == 'Hourly' else when.strftime('%Y-%m')
+    if column == 'Current_Leak_Rate':
+        return '0.5' if meter % 50 == 0 else None
+    if column == 'Current_Leak_Start_Date':
+        return '2024-01-01 02:00' if meter % 50 == 0 else None
+    if column == 'Backflow_Gallons':
+        return '1.0' if meter % 97 == 0 else None
+    if column == 'Battery_Level':
+        return str(5 + meter % 95)
+    if column == 'Service_Point_Latitude':
+        return f'{35.9 + meter % 1000 * 0.0001:.6f}'
+    if column == 'Service_Point_Longitude':
+        return f'{-86.8 - meter // 1000 * 0.0001:.6f}'
+    if column == 'SA_Start_Date':
+        return '2015-06'
+    if column == 'Read_Method':
+        return 'Network'
+    return None
+
+
+#an export that was posted, it sits in the queue then runs for the configured delays before it's done
+class FakeExport:
+    def __init__(self, params, server):
+        self.uuid = str(uuid.uuid4())
+        self.created = time.monotonic()
+        self.params = params
+        self.server = server
+
+    def state(self):
+        elapsed = time.monotonic() - self.created
+        if elapsed < self.server.queue_delay:
+            return 'queue'
+        if elapsed < self.server.queue_delay + self.server.run_delay:
+            return 'run'
+        return 'done'
+
+    #the records beacon would put in the report, one per meter per hour or month in the range
+    def records(self):
+        columns = self.params['Header_Columns'].split(',')
+        resolution = self.params.get('Resolution', 'Hourly')
+        start = dt.datetime.fromisoformat(self.params['Start_Date'])
+        end = dt.datetime.fromisoformat(self.params['End_Date'])
+
+        route = self.params.get('Service_Point_Route')
+        routes = [route] if route else self.server.routes
+        if resolution == 'Hourly':
+            step = dt.timedelta(hours=1)
+            times = []
+            t = start.replace(minute=0, second=0, microsecond=0)
+            while t <= end:
+                times.append(t)
+                t += step
+        else:
+            times = [start.replace(day=1, hour=0, minute=0, second=0, microsecond=0)]
+
+        for r in routes:
+            for meter in self.server.meters_on(r):
+                for t in times:
+                    yield {c: synthetic_value(c, meter, r, t, resolution) for c in columns}
+
+
+#handles the three beacon urls the functions use
+class BeaconHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if url.path != '/v2/eds/range':
+            return self.send_json({'error': 'not found'}, 404)
+
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        export = FakeExport(params, self.server)
+        self.server.count('range')
+        with self.server.lock:
+            self.server.exports[export.uuid] = export
+        self.send_json({'edsUUID': export.uuid, 'statusUrl': f'/v1/eds/status/{export.uuid}'})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+
+        if parts[:3] == ['v1', 'eds', 'status'] and len(parts) == 4:
+            self.server.count('status')
+            export = self.server.exports.get(parts[3])
+            if export is None:
+                return self.send_json({'error': 'unknown export'}, 404)
+            state = export.state()
+            body = {'state': state}
+            if state == 'done':
+                body['reportUrl'] = f'/reports/{export.uuid}'
+            return self.send_json(body)
+
+        if parts[0] == 'reports' and len(parts) == 2:
+            self.server.count('report')
+            export = self.server.exports.get(parts[1])
+            if export is None:
+                return self.send_json({'error': 'unknown export'}, 404)
+            return self.send_report(export)
+
+        self.send_json({'error': 'not found'}, 404)
+
+    #writes the report a piece at a time like a large download
+    def send_report(self, export):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def write(text):
+            data = text.encode()
+            self.wfile.write(f'{len(data):X}\r\n'.encode() + data + b'\r\n')
+            self.server.count('report bytes', len(data))
+
+        write('{"results": [')
+        buffer = []
+        first = True
+        for record in export.records():
+            buffer.append(('' if first else ',') + json.dumps(record))
+            first = False
+            if len(buffer) >= 500:
+                write(''.join(buffer))
+                buffer = []
+        write(''.join(buffer) + ']}')
+        self.wfile.write(b'0\r\n\r\n')
+
+
+#threaded local server, meters are spread evenly over the routes
+class FakeBeacon(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, meters=1000, routes=('21', '26', '27', '29'), queue_delay=1.0, run_delay=1.0, port=0):
+        super().__init__(('127.0.0.1', port), BeaconHandler)
+        self.meters = meters
+        self.routes = list(routes)
+        self.queue_delay = queue_delay
+        self.run_delay = run_delay
+        self.exports = {}
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    #the client closing its pooled connections when a scenario ends isn't an error
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def meters_on(self, route):
+        i = self.routes.index(route) if route in self.routes else 0
+        return range(i, self.meters, len(self.routes))
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + n
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
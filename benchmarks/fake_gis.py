@@ -0,0 +1,159 @@
+#Purpose: In memory stand ins for the hosted meter layer, its flow table and the badger table with a simulated delay on
+#every call, so the gis functions can be run and timed without the portal
+
+
+import threading
+import time
+from types import SimpleNamespace
+
+
+#a feature as returned by a query
+class FakeFeature:
+    def __init__(self, attributes, geometry=None):
+        self.attributes = attributes
+        self.geometry = geometry
+
+    @property
+    def as_dict(self):
+        d = {'attributes': self.attributes}
+        if self.geometry:
+            d['geometry'] = self.geometry
+        return d
+
+
+class FakeFeatureSet:
+    def __init__(self, features):
+        self.features = features
+
+
+#the parts of a feature layer or table the functions use. latency is the seconds each call takes on top of the work
+class FakeLayer:
+    def __init__(self, latency=0.05, wkid=6318, related=None):
+        self.latency = latency
+        self.rows = {}
+        self.geometry = {}
+        self.next_oid = 1
+        self.related = related
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.properties = SimpleNamespace(extent=SimpleNamespace(spatialReference={'wkid': wkid}))
+
+    def count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        time.sleep(self.latency)
+
+    def insert(self, attributes, geometry=None):
+        oid = self.next_oid
+        self.next_oid += 1
+        self.rows[oid] = dict(attributes, objectid=oid)
+        if geometry:
+            self.geometry[oid] = dict(geometry)
+        return oid
+
+    #matches '1=1' or clauses like "field = value" joined with OR
+    def matches(self, attributes, where):
+        if where in (None, '', '1=1'):
+            return True
+        for clause in where.split(' OR '):
+            field, value = [p.strip() for p in clause.split('=', 1)]
+            value = value.strip("'").replace("''", "'")
+            if str(attributes.get(field)) == value:
+                return True
+        return False
+
+    def query(self, where='1=1', out_fields='*', return_geometry=True, order_by_fields=None, result_offset=0,
+              result_record_count=None, **kwargs):
+        self.count('query')
+        with self.lock:
+            oids = sorted(oid for oid, a in self.rows.items() if self.matches(a, where))
+        end = None if result_record_count is None else result_offset + result_record_count
+        features = []
+        for oid in oids[result_offset:end]:
+            attributes = self.rows[oid]
+            if out_fields != '*':
+                attributes = {f: attributes.get(f) for f in out_fields.split(',')}
+            else:
+                attributes = dict(attributes)
+            geometry = dict(self.geometry[oid]) if return_geometry and oid in self.geometry else None
+            features.append(FakeFeature(attributes, geometry))
+        return FakeFeatureSet(features)
+
+    def edit_features(self, adds=None, updates=None):
+        self.count('edit_features')
+        result = {'addResults': [], 'updateResults': []}
+        with self.lock:
+            for a in adds or []:
+                a = a.as_dict if isinstance(a, FakeFeature) else a
+                oid = self.insert(a['attributes'], a.get('geometry'))
+                result['addResults'].append({'objectId': oid, 'success': True})
+            for u in updates or []:
+                u = u.as_dict if isinstance(u, FakeFeature) else u
+                oid = u['attributes'].get('objectid')
+                if oid not in self.rows:
+                    result['updateResults'].append({'objectId': oid, 'success': False,
+                                                    'error': {'description': 'no such feature'}})
+                    continue
+                self.rows[oid].update(u['attributes'])
+                if u.get('geometry'):
+                    self.geometry[oid] = dict(u['geometry'])
+                result['updateResults'].append({'objectId': oid, 'success': True})
+        return result
+
+    #related flow records joined on endpoint_sn, the way the model's relationship works
+    def query_related_records(self, object_ids, relationship_id='0', **kwargs):
+        self.count('query_related_records')
+        groups = []
+        for oid in str(object_ids).split(','):
+            sn = self.rows[int(oid)].get('endpoint_sn')
+            records = [{'attributes': dict(r)} for r in self.related.rows.values() if r.get('endpoint_sn') == sn]
+            groups.append({'objectId': int(oid), 'relatedRecords': records})
+        return {'relatedRecordGroups': groups}
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+
+#hosted item with layers and tables
+class FakeItem:
+    def __init__(self, layers, tables):
+        self.layers = layers
+        self.tables = tables
+        self.title = 'fake item'
+
+
+#stands in for the shared portal connection
+class FakeConnection:
+    def __init__(self, items):
+        self.items = items
+        self.gis = SimpleNamespace(content=SimpleNamespace(get=self.item))
+
+    def item(self, item_id):
+        return self.items[item_id]
+
+    def layer(self, item_id, index=0):
+        return self.items[item_id].layers[index]
+
+    def table(self, item_id, index=0):
+        return self.items[item_id].tables[index]
+
+
+#the water meter model with meters already on it, each with a flow table row for every month of the year
+def fake_model(meters, latency=0.05, year=2023):
+    table = FakeLayer(latency)
+    layer = FakeLayer(latency, related=table)
+    for m in range(meters):
+        sn = 100000000 + m
+        attributes = {
+            'endpoint_sn': sn,
+            'location_address': f'{100 + m % 9000} Route {("21", "26", "27", "29")[m % 4]} Rd',
+            'account_full_name': f'Customer {m}',
+        }
+        for month in ('january', 'february', 'march', 'april', 'may', 'june', 'july', 'august', 'september',
+                      'october', 'november', 'december'):
+            attributes[f'{month}_gpm'] = None if (m + len(month)) % 7 == 0 else (m % 37) / 10
+        attributes.update(annual_avg=None, summer_flow=None, peak_flow=None)
+        layer.insert(attributes, {'x': -86.8, 'y': 35.9, 'spatialReference': {'wkid': 6318}})
+        for month in range(1, 13):
+            stamp = time.mktime((year, month, 1, 0, 0, 0, 0, 0, -1)) * 10 ** 3
+            table.insert({'endpoint_sn': sn, 'flow': float(1000 + m % 500), 'flow_time': stamp})
+    return FakeItem([layer], [table])
@@ -0,0 +1,172 @@
+#Purpose: Runs the data collection and model update functions against the local beacon and portal stand ins and
+#records wall time, call counts and peak memory so versions of the scripts can be compared
+
+#usage: python benchmarks/run_benchmarks.py --sizes 1000 10000 --output bench.json
+
+
+import argparse
+import datetime as dt
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import beacon_api_functions as bapi
+from fake_beacon import FakeBeacon, synthetic_value
+from fake_gis import FakeConnection, FakeItem, FakeLayer, fake_model
+
+
+ROUTES = ['21', '26', '27', '29']
+#the journal is only kept for the run so every benchmark updates every meter
+GPS = {'username': 'bench', 'password': 'bench', 'journal_file': ':memory:'}
+
+
+#beacon config section pointing at the local server, the rate limit is loose so it isn't what gets measured
+def beacon_config(server):
+    return {'username': 'bench', 'password': 'bench', 'content_type': 'application/json',
+            'base_url': server.base_url, 'rate_limit': '100', 'rate_burst': '100'}
+
+
+#short polling waits so the fake queue delays are what gets measured
+def fast_strategy():
+    return bapi.PollStrategy(initial=0.05, factor=1.5, max_delay=1.0, max_wait=600)
+
+
+#point the gis functions at the fake items
+def use_portal(items):
+    connection = FakeConnection(items)
+    bapi.get_connection = lambda g, shared=True: connection
+    return connection
+
+
+def collect_all(size, args):
+    server = FakeBeacon(size, ROUTES, args.queue_delay, args.run_delay).start()
+    try:
+        store = bapi.collect_all(beacon_config(server), ROUTES, strategy=fast_strategy())
+    finally:
+        server.stop()
+    return {'rows': sum(len(v) for v in store.values()), 'beacon_calls': server.calls}
+
+
+def update_model(size, args):
+    server = FakeBeacon(size, ROUTES, args.queue_delay, args.run_delay).start()
+    s_time = dt.datetime(2024, 6, 1)
+    e_time = dt.datetime(2024, 6, 30, 23, 59, 59)
+    try:
+        data = bapi.monthly_audit(s_time, e_time, beacon_config(server), strategy=fast_strategy())
+    finally:
+        server.stop()
+
+    #most of the meters are already on the model, the rest get built
+    model = fake_model(int(size * 0.95), args.latency)
+    use_portal({bapi.MODEL_ITEM: model})
+    result = bapi.update_model(data, dt.datetime(2024, 8, 1), GPS, workers=args.workers)
+    return {'rows': len(data[0]), 'meters': result['meters'], 'errors': result['errors'], 'beacon_calls': server.calls,
+            'gis_calls': {'layer': model.layers[0].calls, 'table': model.tables[0].calls}}
+
+
+def averages(size, args):
+    model = fake_model(size, args.latency)
+    use_portal({bapi.MODEL_ITEM: model})
+    bapi.monthly_average(GPS)
+    bapi.averages(GPS)
+    return {'rows': size, 'gis_calls': {'layer': model.layers[0].calls, 'table': model.tables[0].calls}}
+
+
+#hourly route data like collect_all returns
+def hourly_store(size, args):
+    start = dt.datetime(2024, 6, 3, 6)
+    columns = bapi.HOURLY_COLUMNS.split(',')
+    store = {}
+    for i, r in enumerate(ROUTES):
+        store[r] = []
+        for meter in range(i, size, len(ROUTES)):
+            for h in range(args.hours):
+                when = start + dt.timedelta(hours=h)
+                store[r].append({c: synthetic_value(c, meter, r, when, 'Hourly') for c in columns})
+    return store
+
+
+def store_in_gis(size, args):
+    store = hourly_store(size, args)
+    table = FakeLayer(args.latency)
+    use_portal({bapi.BADGER_ITEM: FakeItem([], [table])})
+    result = bapi.store_in_gis(store, GPS)
+    return {'rows': result['rows'], 'rows_per_second': result['rows_per_second'], 'gis_calls': table.calls}
+
+
+def leak_summary(size, args):
+    store = hourly_store(size, args)
+    table = FakeLayer(args.latency)
+    use_portal({'leak summary': FakeItem([], [table])})
+    result = bapi.store_leak_summary(store, dict(GPS, leak_summary_item='leak summary'))
+    return {'rows': sum(len(v) for v in store.values()), 'summary_rows': len(result['rows']),
+            'analysis_seconds': result['seconds'], 'gis_calls': table.calls}
+
+
+SCENARIOS = {
+    'collect_all': collect_all,
+    'update_model': update_model,
+    'averages': averages,
+    'store_in_gis': store_in_gis,
+    'leak_summary': leak_summary
+}
+
+
+#run one scenario at one size and measure it
+def run(name, size, args):
+    bapi.metrics.reset()
+    if args.memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    details = SCENARIOS[name](size, args)
+    wall = time.perf_counter() - start
+    peak = None
+    if args.memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {'scenario': name, 'meters': size, 'wall_seconds': wall, 'peak_bytes': peak, 'details': details,
+            'calls': bapi.metrics.report()['calls']}
+
+
+def version():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the water meter model scripts offline')
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000])
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every fake portal call')
+    parser.add_argument('--queue-delay', type=float, default=1.0, help='seconds a fake export waits in the queue')
+    parser.add_argument('--run-delay', type=float, default=1.0, help='seconds a fake export runs')
+    parser.add_argument('--hours', type=int, default=24, help='hours of data per meter for store_in_gis')
+    parser.add_argument('--workers', type=int, default=1, help='update_model shards run at the same time')
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help='skip tracemalloc peak memory')
+    parser.add_argument('--output', default='bench_output.json')
+    args = parser.parse_args()
+
+    results = []
+    for name in args.scenarios:
+        for size in args.sizes:
+            result = run(name, size, args)
+            results.append(result)
+            peak = f'{result["peak_bytes"] / 2 ** 20:.1f} MB' if result['peak_bytes'] is not None else '-'
+            print(f'{name:>14} {size:>8} meters  {result["wall_seconds"]:9.2f} s  {peak}')
+
+    with open(args.output, 'w') as f:
+        json.dump({'version': version(), 'run_at': dt.datetime.now().isoformat(), 'results': results}, f, indent=2,
+                  default=str)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#Purpose: Keeps a hash of each meter's account attributes in a local file so the monthly update only rewrites the
+#meters whose attributes actually changed
+
+
+import hashlib
+import json
+import os
+import threading
+
+
+#the meter attributes that come from beacon's account data every month
+TRACKED_FIELDS = ['account_full_name', 'account_id', 'endpoint_sn', 'location_address', 'location_city',
+                  'sa_start_date', 'read_method']
+
+
+#hash of the tracked attributes, dates and other values are compared by their text
+def content_hash(attributes):
+    values = [attributes.get(f) for f in TRACKED_FIELDS]
+    return hashlib.sha1(json.dumps(values, default=str).encode()).hexdigest()
+
+
+#compares incoming attributes against the hashes saved from the last run. the hashes are kept in a json file next to
+#the script keyed by objectid, without a path nothing is saved and every meter counts as changed
+class ChangeTracker:
+    def __init__(self, path=None):
+        self.path = path
+        self.hashes = {}
+        if path is not None and os.path.isfile(path):
+            with open(path) as f:
+                self.hashes = json.load(f)
+        self.created = []
+        self.counts = {'new': 0, 'changed': 0, 'unchanged': 0}
+        #update_model shards share one tracker
+        self.lock = threading.Lock()
+
+    #True if the attributes are different from the last run for this objectid
+    def check(self, oid, attributes):
+        new = content_hash(attributes)
+        with self.lock:
+            if oid is not None and self.hashes.get(str(oid)) == new:
+                self.counts['unchanged'] += 1
+                return False
+
+            self.counts['changed'] += 1
+            if oid is not None:
+                self.hashes[str(oid)] = new
+        return True
+
+    #a meter built this run, its hash is saved once the portal gives it an objectid
+    def add(self, attributes):
+        with self.lock:
+            self.counts['new'] += 1
+            self.created.append(attributes)
+
+    #drop the hashes of edits the portal rejected so they are sent again next run
+    def forget(self, failures):
+        with self.lock:
+            for failure in failures:
+                for feature in failure['features']:
+                    self.hashes.pop(str(feature['attributes'].get('objectid')), None)
+
+    def save(self):
+        with self.lock:
+            for attributes in self.created:
+                if attributes.get('objectid') is not None:
+                    self.hashes[str(attributes['objectid'])] = content_hash(attributes)
+            self.created = []
+
+            if self.path is None:
+                return
+            with open(f'{self.path}.tmp', 'w') as f:
+                json.dump(self.hashes, f)
+            os.replace(f'{self.path}.tmp', self.path)
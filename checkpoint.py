@@ -0,0 +1,139 @@
+#Purpose: Keeps a local journal of the monthly update so a run that dies partway can be started again without redoing
+#the meters that are already done or adding their flow rows twice
+
+
+import datetime as dt
+import sqlite3
+import threading
+
+
+#where the journal is kept when the config file doesn't name one (journal_file in the GIS section)
+JOURNAL_FILE = 'water_model_journal.sqlite'
+
+
+#the key a beacon row is journaled under, its serial number or its address if it doesn't have one
+def row_key(sn, address):
+    if sn is not None:
+        return str(sn)
+    return f'address:{address}'
+
+
+#sqlite journal of the meters processed for each period, the flow table rows that have been added and the one time
+#steps like the march archive. ':memory:' keeps it for the current run only
+class RunJournal:
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS processed (
+                period TEXT NOT NULL,
+                row_key TEXT NOT NULL,
+                PRIMARY KEY (period, row_key)
+            );
+            CREATE TABLE IF NOT EXISTS flow_rows (
+                endpoint_sn TEXT NOT NULL,
+                flow_time TEXT NOT NULL,
+                PRIMARY KEY (endpoint_sn, flow_time)
+            );
+            CREATE TABLE IF NOT EXISTS steps (
+                name TEXT NOT NULL,
+                period TEXT NOT NULL,
+                done_at TEXT NOT NULL,
+                PRIMARY KEY (name, period)
+            );
+        ''')
+        self.db.commit()
+
+    #the keys of the rows already processed for a period, loaded once at the start of a run
+    def processed(self, period):
+        with self.lock:
+            rows = self.db.execute('SELECT row_key FROM processed WHERE period = ?', (period,)).fetchall()
+        return {r[0] for r in rows}
+
+    def has_flow(self, sn, flow_time):
+        with self.lock:
+            row = self.db.execute('SELECT 1 FROM flow_rows WHERE endpoint_sn = ? AND flow_time = ?',
+                                  (str(sn), flow_time.isoformat())).fetchone()
+        return row is not None
+
+    def step_done(self, name, period):
+        with self.lock:
+            row = self.db.execute('SELECT 1 FROM steps WHERE name = ? AND period = ?', (name, period)).fetchone()
+        return row is not None
+
+    def mark_step(self, name, period):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO steps VALUES (?, ?, ?)',
+                            (name, period, dt.datetime.now().isoformat()))
+            self.db.commit()
+
+    def batch(self, period):
+        return JournalBatch(self, period)
+
+    #write a batch once its edits have been sent to the portal. rows with an edit the portal rejected are left out so
+    #the next run does them again
+    def commit(self, batch, failures=()):
+        failed_keys = set()
+        failed_flows = set()
+        for failure in failures:
+            for feature in failure['features']:
+                attributes = feature['attributes']
+                oid = attributes.get('objectid')
+                if oid in batch.oids:
+                    failed_keys.add(batch.oids[oid])
+                #a flow row is traced back to the beacon row it was added for, its attributes don't have the address
+                if id(feature) in batch.tables:
+                    failed_keys.add(batch.tables[id(feature)][1])
+                if 'location_address' in attributes or 'endpoint_sn' in attributes:
+                    failed_keys.add(row_key(attributes.get('endpoint_sn'), attributes.get('location_address')))
+                if 'flow' in attributes:
+                    failed_flows.add(batch.flow_key(attributes.get('endpoint_sn'), attributes.get('flow_time')))
+
+        keys = [(batch.period, k) for k in batch.keys if k not in failed_keys]
+        flows = [f for f in batch.flows if f not in failed_flows]
+        with self.lock:
+            self.db.executemany('INSERT OR IGNORE INTO processed VALUES (?, ?)', keys)
+            self.db.executemany('INSERT OR IGNORE INTO flow_rows VALUES (?, ?)', flows)
+            self.db.commit()
+
+        batch.clear()
+        return len(keys)
+
+
+#the rows processed since the last commit. nothing is written to the journal until the edits are on the portal
+class JournalBatch:
+    def __init__(self, journal, period):
+        self.journal = journal
+        self.period = period
+        self.keys = []
+        self.oids = {}
+        self.flows = set()
+        #the flow rows added for this batch by id, with the key of the beacon row each one is for
+        self.tables = {}
+
+    def flow_key(self, sn, flow_time):
+        return str(sn), flow_time.isoformat() if flow_time is not None else None
+
+    def mark(self, key, oid=None):
+        self.keys.append(key)
+        if oid is not None:
+            self.oids[oid] = key
+
+    #True if the flow row in table for the beacon row d hasn't been added yet, the row is then claimed for this batch.
+    #rows without a serial number can't be told apart in the flow table so theirs are always added
+    def claim(self, d, table):
+        self.tables[id(table)] = (table, row_key(d.sn, d.address))
+        if d.flow_time is None or d.sn is None:
+            return True
+        key = self.flow_key(d.sn, d.flow_time)
+        if key in self.flows or self.journal.has_flow(d.sn, d.flow_time):
+            return False
+        self.flows.add(key)
+        return True
+
+    def clear(self):
+        self.keys = []
+        self.oids = {}
+        self.flows = set()
+        self.tables = {}
@@ -0,0 +1,151 @@
+#Purpose: Keeps finished beacon exports on disk in a compact columnar format so re-runs and backfills only request the
+#time ranges that haven't been downloaded yet
+
+
+import datetime as dt
+import hashlib
+import json
+import os
+import threading
+import uuid
+import numpy as np
+
+
+#one lock per cache folder shared by every ExportCache on it, so two caches on the same folder in one process don't
+#overwrite each other's manifest entries
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def directory_lock(directory):
+    with _locks_lock:
+        return _locks.setdefault(os.path.abspath(directory), threading.Lock())
+
+
+#on disk cache of beacon exports. each export kind (resolution, route and header columns) gets its own folder with a
+#manifest of the time ranges it covers and one .npz file of columns per range that was downloaded
+class ExportCache:
+    def __init__(self, directory, settle=dt.timedelta(0)):
+        self.directory = directory
+        #ranges ending less than settle ago aren't saved since beacon may still be receiving reads for them
+        self.settle = settle
+        self.lock = directory_lock(directory)
+        self.fetched = 0
+        self.loaded = 0
+
+    #folder for one kind of export, the key is (resolution, route, header columns)
+    def folder(self, key):
+        name = hashlib.sha1(json.dumps(list(key)).encode()).hexdigest()[:16]
+        return os.path.join(self.directory, f'{key[0]}_{key[1]}_{name}'.lower())
+
+    def manifest(self, folder):
+        path = os.path.join(folder, 'manifest.json')
+        if not os.path.isfile(path):
+            return []
+        with open(path) as f:
+            return json.load(f)
+
+    def save_manifest(self, folder, chunks):
+        path = os.path.join(folder, 'manifest.json')
+        #each write gets its own temp file so two writes at once, like from two processes, don't share one
+        temp = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(temp, 'w') as f:
+            json.dump(chunks, f, indent=1)
+        os.replace(temp, path)
+
+    #returns the records between s_time and e_time. cached ranges are read from disk and only the missing ranges are
+    #requested with fetch(start, end), which returns a list of records. time_format is how Flow_Time is written in the
+    #records, for example '%Y-%m-%d %H:%M' for hourly data
+    def get(self, key, s_time, e_time, fetch, time_format):
+        folder = self.folder(key)
+        columns = key[2].split(',')
+        with self.lock:
+            os.makedirs(folder, exist_ok=True)
+            chunks = self.manifest(folder)
+
+        covered = [(dt.datetime.fromisoformat(c['start']), dt.datetime.fromisoformat(c['end'])) for c in chunks]
+        fresh = []
+        for start, end in missing(covered, s_time, e_time):
+            rows = fetch(start, end)
+            self.fetched += len(rows)
+            fresh.append(rows)
+            if end <= dt.datetime.now() - self.settle:
+                with self.lock:
+                    name = f'{start:%Y%m%d%H%M%S}_{end:%Y%m%d%H%M%S}.npz'
+                    save_columns(os.path.join(folder, name), rows, columns)
+                    chunks = self.manifest(folder)
+                    chunks.append({'start': start.isoformat(), 'end': end.isoformat(), 'file': name,
+                                   'rows': len(rows)})
+                    self.save_manifest(folder, chunks)
+
+        #read the cached ranges that overlap the request, the newest download of a record wins
+        stored = []
+        for c in chunks:
+            start, end = dt.datetime.fromisoformat(c['start']), dt.datetime.fromisoformat(c['end'])
+            if start <= e_time and end >= s_time and os.path.isfile(os.path.join(folder, c['file'])):
+                stored.append(load_columns(os.path.join(folder, c['file']), columns))
+        self.loaded += sum(len(rows) for rows in stored)
+
+        records = {}
+        for rows in stored + fresh:
+            for r in rows:
+                flow_time = r.get('Flow_Time')
+                if flow_time is not None:
+                    when = dt.datetime.strptime(flow_time, time_format)
+                    if when < s_time.replace(second=0, microsecond=0) or when > e_time:
+                        continue
+                records[(r.get('Endpoint_SN'), r.get('Location_Address_Line1'), flow_time)] = r
+
+        return list(records.values())
+
+
+#the parts of start to end that aren't covered by any of the ranges
+def missing(covered, start, end):
+    gaps = []
+    for c_start, c_end in sorted(covered):
+        if c_end < start:
+            continue
+        if c_start > end:
+            break
+        if c_start > start:
+            gaps.append((start, c_start))
+        start = max(start, c_end)
+    if start < end:
+        gaps.append((start, end))
+    return gaps
+
+
+#writes the records as one array per column with a mask for the None values. columns that are all whole numbers or all
+#numbers are stored as numbers, everything else as strings
+def save_columns(path, rows, columns):
+    arrays = {}
+    for c in columns:
+        values = [r.get(c) for r in rows]
+        mask = np.array([v is None for v in values], dtype=bool)
+        present = [v for v in values if v is not None]
+        if present and all(isinstance(v, int) and not isinstance(v, bool) for v in present):
+            column = np.array([0 if v is None else v for v in values], dtype=np.int64)
+        elif present and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in present):
+            column = np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+        else:
+            column = np.array(['' if v is None else str(v) for v in values], dtype=str)
+        arrays[f'value_{c}'] = column
+        arrays[f'mask_{c}'] = mask
+
+    with open(path, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+
+
+#reads records written by save_columns back into dictionaries like the ones in a beacon report
+def load_columns(path, columns):
+    with np.load(path) as data:
+        loaded = {c: (data[f'value_{c}'].tolist(), data[f'mask_{c}'].tolist()) for c in columns if f'value_{c}' in data}
+
+    if not loaded:
+        return []
+    size = len(next(iter(loaded.values()))[0])
+    rows = [{} for _ in range(size)]
+    for c, (values, mask) in loaded.items():
+        for row, v, m in zip(rows, values, mask):
+            row[c] = None if m else v
+    return rows
@@ -0,0 +1,89 @@
+#Purpose: Turns the hourly route data from collect_all into typed columns in one pass so it can be added to the badger
+#table in large chunks
+
+
+import datetime as dt
+import numpy as np
+from records import shared
+
+
+#text fields copied from the beacon records as they are
+TEXT_FIELDS = {
+    'account_full_name': 'Account_Full_Name',
+    'endpoint_sn': 'Endpoint_SN',
+    'endpoint_type': 'Endpoint_Type',
+    'flow_unit': 'Flow_Unit',
+    'location_address_line1': 'Location_Address_Line1',
+    'battery_level': 'Battery_Level'
+}
+#number fields where a missing value is stored as 0
+NUMBER_FIELDS = {
+    'flow': 'Flow',
+    'current_leak_rate': 'Current_Leak_Rate',
+    'backflow_gallons': 'Backflow_Gallons'
+}
+
+
+#floats for a column of beacon values, None becomes 0 like the old per row conversion
+def numbers(values):
+    return np.nan_to_num(np.array([np.nan if v is None else v for v in values], dtype=np.float64), nan=0.0)
+
+
+#unix timestamps in milliseconds (local time, the way gis stores them) for a column of beacon time strings, missing
+#values are nan. there are only a few distinct times in a day of hourly data so each one is parsed once
+def epoch_ms(values, on_the_hour=False):
+    values = np.array(['' if v is None else v for v in values], dtype=str)
+    unique, inverse = np.unique(values, return_inverse=True)
+
+    stamps = np.full(len(unique), np.nan)
+    for i, u in enumerate(unique):
+        if not u:
+            continue
+        t = dt.datetime.strptime(u, '%Y-%m-%d %H:%M')
+        if on_the_hour:
+            t = t.replace(minute=0)
+        stamps[i] = dt.datetime.timestamp(t) * 10 ** 3
+
+    return stamps[inverse.reshape(-1)]
+
+
+#True for the rows beacon reported a flow for, in the same order as flow_columns. the flow column has 0 for the others
+#so they can't be told apart from an hour with no flow
+def reported_flow(store):
+    return np.array([r['Flow'] is not None for s in store for r in store[s]], dtype=bool)
+
+
+#all the routes in the store as one set of typed columns ready for the badger table
+def flow_columns(store):
+    records = []
+    routes = []
+    for s in store:
+        records += store[s]
+        routes += [int(s)] * len(store[s])
+
+    columns = {name: [r[key] for r in records] for name, key in TEXT_FIELDS.items()}
+    #the unit, endpoint type and battery level repeat on every row so they share one copy of each string
+    for name in ('flow_unit', 'endpoint_type', 'battery_level'):
+        columns[name] = [shared(v) for v in columns[name]]
+    for name, key in NUMBER_FIELDS.items():
+        columns[name] = numbers([r[key] for r in records])
+    columns['current_leak_start_date'] = epoch_ms([r['Current_Leak_Start_Date'] for r in records])
+    columns['flow_time'] = epoch_ms([r['Flow_Time'] for r in records], on_the_hour=True)
+    columns['service_point_route'] = np.array(routes, dtype=np.int64)
+
+    return columns
+
+
+#portal compatible dictionaries for the rows in the columns, missing dates are None
+def table_rows(columns):
+    names = list(columns)
+    values = []
+    for name in names:
+        column = columns[name]
+        if isinstance(column, np.ndarray):
+            if column.dtype.kind == 'f' and name in ('current_leak_start_date', 'flow_time'):
+                column = np.where(np.isnan(column), None, column)
+            column = column.tolist()
+        values.append(column)
+
+    return [{'attributes': dict(zip(names, row))} for row in zip(*values)]
@@ -0,0 +1,139 @@
+#Purpose: Keeps the hourly flow data in a local sqlite file with daily and monthly totals kept up to date as it's added,
+#so a meter's history and its monthly gpm can be looked up without going back to beacon or the portal
+
+
+import calendar
+import datetime as dt
+import sqlite3
+import threading
+import numpy as np
+from meter_stats import MONTH_MINUTES
+from records import to_int
+
+
+#sqlite store of the hourly flow of every meter keyed by (endpoint_sn, flow_time), flow_time is the unix timestamp in
+#milliseconds like the badger table. the daily and monthly tables are totals of the hourly flow and the number of hours
+#that went into them, they are updated with the difference each ingest makes so an hour that's loaded again replaces
+#its old value instead of being counted twice
+class FlowStore:
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS hourly (
+                endpoint_sn INTEGER NOT NULL,
+                flow_time INTEGER NOT NULL,
+                flow REAL NOT NULL,
+                PRIMARY KEY (endpoint_sn, flow_time)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS hourly_time ON hourly (flow_time);
+            CREATE TABLE IF NOT EXISTS daily (
+                endpoint_sn INTEGER NOT NULL,
+                day TEXT NOT NULL,
+                flow REAL NOT NULL,
+                hours INTEGER NOT NULL,
+                PRIMARY KEY (endpoint_sn, day)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS monthly (
+                endpoint_sn INTEGER NOT NULL,
+                month TEXT NOT NULL,
+                flow REAL NOT NULL,
+                hours INTEGER NOT NULL,
+                PRIMARY KEY (endpoint_sn, month)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS monthly_month ON monthly (month);
+        ''')
+        self.db.commit()
+
+    #add the hourly rows from flow_columns. rows without a serial number or time (nan) are skipped, and so are the rows
+    #reported (from reported_flow) is False for so an hour without a read doesn't count towards a month's coverage. the
+    #last row for an hour wins. returns the number of hours that were new
+    def ingest(self, columns, reported=None):
+        times = np.asarray(columns['flow_time'], dtype=np.float64).tolist()
+        flows = np.asarray(columns['flow'], dtype=np.float64).tolist()
+        if reported is None:
+            reported = np.ones(len(times), dtype=bool)
+        rows = [(sn, int(t), f) for sn, t, f, r in zip(map(to_int, columns['endpoint_sn']), times, flows, reported)
+                if sn is not None and t == t and r]
+
+        with self.lock:
+            db = self.db
+            db.execute('''
+                CREATE TEMP TABLE IF NOT EXISTS staged (
+                    endpoint_sn INTEGER NOT NULL,
+                    flow_time INTEGER NOT NULL,
+                    flow REAL NOT NULL,
+                    PRIMARY KEY (endpoint_sn, flow_time)
+                )
+            ''')
+            db.execute('DELETE FROM staged')
+            db.executemany('INSERT OR REPLACE INTO staged VALUES (?, ?, ?)', rows)
+
+            #the change each staged hour makes to the totals, the new flow less the old one if the hour was already in
+            db.execute('DROP TABLE IF EXISTS temp.changes')
+            db.execute('''
+                CREATE TEMP TABLE changes AS
+                SELECT s.endpoint_sn, s.flow_time,
+                       strftime('%Y-%m-%d', s.flow_time / 1000, 'unixepoch', 'localtime') AS day,
+                       s.flow - COALESCE(h.flow, 0) AS flow,
+                       h.flow IS NULL AS added
+                FROM staged s LEFT JOIN hourly h ON h.endpoint_sn = s.endpoint_sn AND h.flow_time = s.flow_time
+            ''')
+            db.execute('INSERT OR REPLACE INTO hourly SELECT endpoint_sn, flow_time, flow FROM staged')
+            db.execute('''
+                INSERT INTO daily SELECT endpoint_sn, day, SUM(flow), SUM(added) FROM changes
+                GROUP BY endpoint_sn, day
+                ON CONFLICT (endpoint_sn, day)
+                DO UPDATE SET flow = flow + excluded.flow, hours = hours + excluded.hours
+            ''')
+            db.execute('''
+                INSERT INTO monthly SELECT endpoint_sn, substr(day, 1, 7), SUM(flow), SUM(added) FROM changes
+                GROUP BY endpoint_sn, substr(day, 1, 7)
+                ON CONFLICT (endpoint_sn, month)
+                DO UPDATE SET flow = flow + excluded.flow, hours = hours + excluded.hours
+            ''')
+            added = db.execute('SELECT COALESCE(SUM(added), 0) FROM changes').fetchone()[0]
+            db.commit()
+
+        return added
+
+    #one meter's hourly flow between start and end as (datetime, flow) pairs
+    def hours(self, sn, start, end):
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT flow_time, flow FROM hourly WHERE endpoint_sn = ? AND flow_time BETWEEN ? AND ? '
+                'ORDER BY flow_time', (int(sn), timestamp_ms(start), timestamp_ms(end))
+            ).fetchall()
+        return [(dt.datetime.fromtimestamp(t * 10 ** -3), flow) for t, flow in rows]
+
+    #one meter's daily totals between start and end as (day, flow, hours) with days like '2024-06-03'
+    def days(self, sn, start, end):
+        with self.lock:
+            return self.db.execute(
+                'SELECT day, flow, hours FROM daily WHERE endpoint_sn = ? AND day BETWEEN ? AND ? ORDER BY day',
+                (int(sn), f'{start:%Y-%m-%d}', f'{end:%Y-%m-%d}')
+            ).fetchall()
+
+    #every meter's total flow and hours for a month, like '2024-06', as {endpoint_sn: (flow, hours)}
+    def month_totals(self, month):
+        with self.lock:
+            rows = self.db.execute('SELECT endpoint_sn, flow, hours FROM monthly WHERE month = ?', (month,)).fetchall()
+        return {sn: (flow, hours) for sn, flow, hours in rows}
+
+    #the months that have data, oldest first
+    def months(self):
+        with self.lock:
+            return [r[0] for r in self.db.execute('SELECT DISTINCT month FROM monthly ORDER BY month')]
+
+    #the average gpm of every meter for a month the same way the monthly audit's flow is turned into the *_gpm fields.
+    #meters with hourly data for less than coverage of the month are left out since their total would be short
+    def monthly_gpm(self, month, coverage=0.95):
+        year, number = (int(p) for p in month.split('-'))
+        needed = coverage * calendar.monthrange(year, number)[1] * 24
+        return {sn: flow / MONTH_MINUTES for sn, (flow, hours) in self.month_totals(month).items() if hours >= needed}
+
+
+#one datetime as a unix timestamp in milliseconds, the way flow_time is stored
+def timestamp_ms(when):
+    return int(dt.datetime.timestamp(when) * 10 ** 3)
@@ -0,0 +1,177 @@
+#Purpose: Batches edits to the hosted feature layers so the portal gets a few large edit_features calls instead of one
+#call per meter
+
+
+import numpy as np
+from arcgis.geometry import project
+from instrumentation import metrics
+
+
+#the offset between beacon's service point coordinates and the master layer. I found the difference was basically the
+#same for all the points so it is applied to every new meter before it is added
+X_OFFSET = 1.490687
+Y_OFFSET = -2.50416324
+
+
+#spatial reference beacon reports service point latitude and longitude in
+BEACON_WKID = 6318
+
+
+#get the wkid of the layer's spatial reference, this is what the offsets are measured in
+def layer_wkid(layer):
+    try:
+        sr = layer.properties.extent.spatialReference
+    except (AttributeError, KeyError):
+        return BEACON_WKID
+    return sr.get('latestWkid', sr.get('wkid', BEACON_WKID))
+
+
+#layer coordinates for beacon longitudes and latitudes as arrays. the points are projected into the layer's spatial
+#reference in one server call and the master layer offset is added to all of them at once
+def corrected_xy(xs, ys, out_wkid):
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+
+    if len(xs) and out_wkid != BEACON_WKID:
+        points = [{'x': x, 'y': y, 'spatialReference': {'wkid': BEACON_WKID}} for x, y in zip(xs.tolist(), ys.tolist())]
+        with metrics.timer('gis project'):
+            projected = project(geometries=points, in_sr=BEACON_WKID, out_sr=out_wkid)
+        xs = np.array([p['x'] for p in projected], dtype=np.float64)
+        ys = np.array([p['y'] for p in projected], dtype=np.float64)
+
+    return xs + X_OFFSET, ys + Y_OFFSET
+
+
+#project beacon points into the layer's spatial reference in one server call and apply the master layer offset
+def correct_points(geometries, out_wkid):
+    if not geometries:
+        return geometries
+
+    xs, ys = corrected_xy([g['x'] for g in geometries], [g['y'] for g in geometries], out_wkid)
+    for g, x, y in zip(geometries, xs.tolist(), ys.tolist()):
+        g['x'] = x
+        g['y'] = y
+        g['spatialReference'] = {'wkid': out_wkid}
+
+    return geometries
+
+
+#pages through every feature in a layer or table, fetching only the listed fields. one query per page instead of one
+#per feature
+def query_all(layer, out_fields, page_size=2000, return_geometry=False, where='1=1'):
+    features = []
+    offset = 0
+    while True:
+        with metrics.timer('gis query') as stats:
+            fset = layer.query(where=where, out_fields=out_fields, return_geometry=return_geometry,
+                               order_by_fields='objectid', result_offset=offset, result_record_count=page_size)
+            stats.items += len(fset.features)
+        features += fset.features
+        if len(fset.features) < page_size:
+            break
+        offset += len(fset.features)
+
+    return features
+
+
+#collects adds and updates for a single feature layer or table and sends them to the portal in chunks. it has the same
+#edit_features signature as a layer so it can be passed anywhere a layer is edited
+class EditBatcher:
+    def __init__(self, layer, chunk_size=1000, correct_geometry=False, limiter=None):
+        self.layer = layer
+        self.chunk_size = chunk_size
+        #token bucket shared by every batcher talking to the portal, None sends as fast as the portal answers
+        self.limiter = limiter
+        #new meters come from beacon in lat/long and need to be moved onto the master layer before they're added
+        self.correct_geometry = correct_geometry
+        self.adds = []
+        #updates are keyed by objectid so a feature edited more than once in a run only goes out once
+        self.updates = {}
+        self.failures = []
+        self.sent = 0
+        self.calls = 0
+
+    def edit_features(self, adds=None, updates=None):
+        for a in adds or []:
+            self.adds.append(a)
+        for u in updates or []:
+            self._queue_update(u)
+
+        if len(self.adds) >= self.chunk_size:
+            self.flush_adds()
+        if len(self.updates) >= self.chunk_size:
+            self.flush_updates()
+
+    def _queue_update(self, feature):
+        #features from a query have attributes and geometry properties, new ones are plain dictionaries
+        if isinstance(feature, dict):
+            attributes = feature['attributes']
+            geometry = feature.get('geometry')
+        else:
+            attributes = feature.attributes
+            geometry = feature.geometry
+
+        oid = attributes.get('objectid')
+        #no objectid means the feature is still waiting to be added, the edit is already in the add so skip it
+        if oid is None:
+            return
+
+        pending = self.updates.setdefault(oid, {'attributes': {}})
+        pending['attributes'].update(attributes)
+        if geometry:
+            pending['geometry'] = geometry
+
+    #send everything that is left, call this once the loop over the data is done
+    def flush(self):
+        self.flush_adds()
+        self.flush_updates()
+        return self.failures
+
+    def flush_adds(self):
+        adds, self.adds = self.adds, []
+        for start in range(0, len(adds), self.chunk_size):
+            chunk = adds[start:start + self.chunk_size]
+            if self.correct_geometry:
+                geometries = [a['geometry'] for a in chunk if a.get('geometry')]
+                correct_points(geometries, layer_wkid(self.layer))
+            self._send('add', chunk, start)
+
+    def flush_updates(self):
+        updates = list(self.updates.values())
+        self.updates = {}
+        for start in range(0, len(updates), self.chunk_size):
+            self._send('update', updates[start:start + self.chunk_size], start)
+
+    #sends one chunk and records any features the portal rejected, a failed chunk does not stop the other chunks
+    def _send(self, operation, chunk, start):
+        self.calls += 1
+        if self.limiter is not None:
+            self.limiter.acquire()
+        try:
+            with metrics.timer(f'gis {operation}') as stats:
+                stats.items += len(chunk)
+                if operation == 'add':
+                    resp = self.layer.edit_features(adds=chunk)
+                else:
+                    resp = self.layer.edit_features(updates=chunk)
+        except Exception as e:
+            self.failures.append({'operation': operation, 'chunk_start': start, 'size': len(chunk),
+                                  'error': str(e), 'features': chunk})
+            return
+
+        results = resp.get(f'{operation}Results', [])
+        failed = []
+        for feature, result in zip(chunk, results):
+            if result.get('success'):
+                #remember the new objectid so later edits to this meter in the same run become updates
+                if operation == 'add':
+                    feature['attributes']['objectid'] = result.get('objectId')
+            else:
+                failed.append({'feature': feature, 'error': result.get('error')})
+
+        self.sent += len(chunk) - len(failed)
+        if failed:
+            self.failures.append({'operation': operation, 'chunk_start': start, 'size': len(chunk),
+                                  'error': f'{len(failed)} of {len(chunk)} features failed',
+                                  'features': [f['feature'] for f in failed],
+                                  'errors': [f['error'] for f in failed]})
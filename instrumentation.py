@@ -0,0 +1,178 @@
+#Purpose: Times and counts every call to beacon and the portal, grouped by the stage of the run, and writes a json
+#report at the end so runs can be compared month to month
+
+
+import contextlib
+import cProfile
+import datetime as dt
+import json
+import os
+import threading
+import time
+
+
+#value at fraction p of the sorted samples
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+#latency samples, error count and bytes for one kind of call
+class CallStats:
+    def __init__(self):
+        self.samples = []
+        self.errors = 0
+        self.bytes = 0
+        self.items = 0
+
+    def summary(self):
+        return {
+            'calls': len(self.samples),
+            'errors': self.errors,
+            'seconds': sum(self.samples),
+            'p50': percentile(self.samples, 0.5),
+            'p95': percentile(self.samples, 0.95),
+            'max': max(self.samples, default=0.0),
+            'bytes': self.bytes,
+            'items': self.items
+        }
+
+
+#timers and counters for the run. calls are recorded under the stage the thread making them is in, work handed to other
+#threads is wrapped with carry so it's counted under the stage it was started from
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    #start over, used between benchmark scenarios
+    def reset(self):
+        self.calls = {}
+        self.stages = {}
+        self.results = {}
+        self.local = threading.local()
+        self.started = dt.datetime.now()
+
+    #the stage the calling thread is in, 'run' outside of any stage
+    @property
+    def current(self):
+        return getattr(self.local, 'stage', 'run')
+
+    def stats(self, name, stage=None):
+        key = (stage or self.current, name)
+        with self.lock:
+            if key not in self.calls:
+                self.calls[key] = CallStats()
+            return self.calls[key]
+
+    #time the calls made inside the block as one stage of the run, like 'monthly_audit' or 'averages'
+    @contextlib.contextmanager
+    def stage(self, name):
+        previous, self.local.stage = self.current, name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+            self.local.stage = previous
+
+    #fn wrapped to run in the stage the calling thread is in now, for functions given to a thread pool or thread
+    def carry(self, fn):
+        stage = self.current
+
+        def run(*args, **kwargs):
+            previous, self.local.stage = self.current, stage
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.local.stage = previous
+
+        return run
+
+    #time one call, errors are counted and raised again
+    @contextlib.contextmanager
+    def timer(self, name):
+        stats = self.stats(name)
+        start = time.perf_counter()
+        try:
+            yield stats
+        except Exception:
+            with self.lock:
+                stats.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                stats.samples.append(elapsed)
+
+    #record a duration that wasn't timed with timer, like the time an export spent in beacon's queue
+    def observe(self, name, seconds):
+        stats = self.stats(name)
+        with self.lock:
+            stats.samples.append(seconds)
+
+    def add_bytes(self, name, n):
+        stats = self.stats(name)
+        with self.lock:
+            stats.bytes += n
+
+    def add_items(self, name, n):
+        stats = self.stats(name)
+        with self.lock:
+            stats.items += n
+
+    #keep what a step of the run did, like the number of meters the model update changed, in the report
+    def add_result(self, name, value):
+        with self.lock:
+            self.results[name] = value
+
+    def report(self):
+        with self.lock:
+            calls = {}
+            for (stage, name), stats in sorted(self.calls.items()):
+                calls.setdefault(stage, {})[name] = stats.summary()
+            return {
+                'started': self.started.isoformat(),
+                'finished': dt.datetime.now().isoformat(),
+                'stages': dict(self.stages),
+                'results': dict(self.results),
+                'calls': calls
+            }
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+#the metrics for this process, everything records into this
+metrics = Metrics()
+
+
+#profile the block when WATER_MODEL_PROFILE is set to cprofile or pyinstrument, the output goes to
+#WATER_MODEL_PROFILE_OUT or water_model_profile with the matching extension
+@contextlib.contextmanager
+def profiled():
+    mode = os.environ.get('WATER_MODEL_PROFILE', '').lower()
+    if mode == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(os.environ.get('WATER_MODEL_PROFILE_OUT', 'water_model_profile.prof'))
+    elif mode == 'pyinstrument':
+        from pyinstrument import Profiler
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(os.environ.get('WATER_MODEL_PROFILE_OUT', 'water_model_profile.html'), 'w') as f:
+                f.write(profiler.output_html())
+    else:
+        yield
@@ -0,0 +1,161 @@
+#Purpose: Looks for leaks, backflow and low batteries in the hourly route data with numpy so only a short summary per
+#meter has to be written to gis instead of every hour
+
+
+import datetime as dt
+import numpy as np
+
+
+#hours of the night (local time) when a house with no leak should have no flow at some point
+NIGHT_HOURS = (0, 1, 2, 3, 4)
+#flow at or below this many gallons in an hour counts as no flow
+FLOW_THRESHOLD = 0.1
+#a meter that never stops flowing for this many hours in a row is flagged as a leak
+CONTINUOUS_HOURS = 24
+#battery level below this is reported as low
+LOW_BATTERY = 20
+
+
+#the hourly columns from flow_columns as (meters x hours) arrays. every meter gets a row and every hour in the window
+#gets a column, hours a meter didn't report are nan
+class FlowMatrix:
+    def __init__(self, sns, times, flow, leak_rate, backflow, battery):
+        self.sns = sns
+        self.times = times
+        self.flow = flow
+        self.leak_rate = leak_rate
+        self.backflow = backflow
+        self.battery = battery
+
+    @classmethod
+    def from_columns(cls, columns):
+        times = np.asarray(columns['flow_time'], dtype=np.float64)
+        keep = ~np.isnan(times)
+        sns, meter = np.unique(np.array(columns['endpoint_sn'], dtype=str)[keep], return_inverse=True)
+        times, hour = np.unique(times[keep], return_inverse=True)
+
+        def matrix(values):
+            m = np.full((len(sns), len(times)), np.nan)
+            m[meter.reshape(-1), hour.reshape(-1)] = np.asarray(values, dtype=np.float64)[keep]
+            return m
+
+        return cls(sns, times, matrix(columns['flow']), matrix(columns['current_leak_rate']),
+                   matrix(columns['backflow_gallons']), matrix(levels(columns['battery_level'])))
+
+    #the first and last hour in the window
+    def window(self):
+        if not len(self.times):
+            return None, None
+        return (dt.datetime.fromtimestamp(self.times[0] * 10 ** -3),
+                dt.datetime.fromtimestamp(self.times[-1] * 10 ** -3))
+
+    #the local hour of the day and date of each column, there are only a few dozen columns so each one is converted
+    def clock(self):
+        stamps = [dt.datetime.fromtimestamp(t * 10 ** -3) for t in self.times.tolist()]
+        return np.array([s.hour for s in stamps], dtype=np.int64), np.array([s.date() for s in stamps])
+
+
+#battery levels as numbers, beacon sends them as text. anything that isn't a number is nan
+def levels(values):
+    unique, inverse = np.unique(np.array(['' if v is None else v for v in values], dtype=str), return_inverse=True)
+    converted = np.full(len(unique), np.nan)
+    for i, u in enumerate(unique.tolist()):
+        try:
+            converted[i] = float(u)
+        except ValueError:
+            pass
+    return converted[inverse.reshape(-1)]
+
+
+#the minimum flow of each meter during each night in the window as (meters x nights), with the dates of the nights. a
+#night the meter didn't report in is nan
+def night_minimums(matrix):
+    hours, dates = matrix.clock()
+    night = np.isin(hours, NIGHT_HOURS)
+    nights = np.unique(dates[night])
+
+    minimums = np.full((len(matrix.sns), len(nights)), np.nan)
+    for i, d in enumerate(nights):
+        columns = night & (dates == d)
+        reported = ~np.isnan(matrix.flow[:, columns])
+        values = np.where(reported, matrix.flow[:, columns], np.inf).min(axis=1)
+        minimums[:, i] = np.where(reported.any(axis=1), values, np.nan)
+    return minimums, nights
+
+
+#the longest run of hours in a row with flow above the threshold for each meter, missing hours break a run
+def longest_flow(matrix):
+    flowing = np.nan_to_num(matrix.flow, nan=0.0) > FLOW_THRESHOLD
+    meters, hours = flowing.shape
+    padded = np.zeros((meters, hours + 2), dtype=np.int8)
+    padded[:, 1:-1] = flowing
+    edges = np.diff(padded, axis=1).reshape(-1)
+
+    #with the rows laid end to end every run starts at a +1 and ends at the next -1 in the same row
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    longest = np.zeros(meters, dtype=np.int64)
+    np.maximum.at(longest, starts // (hours + 1), ends - starts)
+    return longest
+
+
+#the last reported value in each row, nan if the row has none
+def latest(values):
+    #no hours in the window, argmax can't be taken over an empty row
+    if values.shape[1] == 0:
+        return np.full(len(values), np.nan)
+    reported = ~np.isnan(values)
+    last = values.shape[1] - 1 - np.argmax(reported[:, ::-1], axis=1)
+    return np.where(reported.any(axis=1), values[np.arange(len(values)), last], np.nan)
+
+
+#the per meter summary of the window as columns. a meter is a leak if it never got down to no flow on any night it
+#reported, or it flowed for CONTINUOUS_HOURS or more without stopping, or beacon is reporting a leak rate for it
+def summarize(matrix):
+    minimums, nights = night_minimums(matrix)
+    reported_nights = ~np.isnan(minimums)
+    steady_nights = (np.where(reported_nights, minimums, 0.0) > FLOW_THRESHOLD).sum(axis=1)
+    longest = longest_flow(matrix)
+    leak_rate = latest(matrix.leak_rate)
+    battery = latest(matrix.battery)
+
+    night_leak = (reported_nights.sum(axis=1) > 0) & (steady_nights == reported_nights.sum(axis=1))
+    leak = night_leak | (longest >= CONTINUOUS_HOURS) | (np.nan_to_num(leak_rate) > 0)
+
+    return {
+        'endpoint_sn': matrix.sns,
+        'hours': (~np.isnan(matrix.flow)).sum(axis=1),
+        'total_flow': np.nansum(matrix.flow, axis=1),
+        'night_min_flow': latest(minimums) if len(nights) else np.full(len(matrix.sns), np.nan),
+        'steady_nights': steady_nights,
+        'longest_flow_hours': longest,
+        'leak': leak,
+        'leak_rate': leak_rate,
+        'backflow_gallons': np.nansum(matrix.backflow, axis=1),
+        'battery_level': battery,
+        'low_battery': battery < LOW_BATTERY
+    }
+
+
+#the meters that have something to report: a leak, any backflow or a low battery
+def flagged(summary):
+    return summary['leak'] | (summary['backflow_gallons'] > 0) | summary['low_battery']
+
+
+#portal compatible dictionaries for the summary rows picked by keep (all of them if keep is None), with the window they
+#cover. nan becomes None and the flags become 1 or 0
+def summary_rows(summary, keep, start, end):
+    if keep is None:
+        keep = np.ones(len(summary['endpoint_sn']), dtype=bool)
+
+    rows = []
+    for i in np.flatnonzero(keep):
+        attributes = {'window_start': start, 'window_end': end}
+        for name, values in summary.items():
+            v = values[i].item()
+            if isinstance(v, bool):
+                v = int(v)
+            attributes[name] = None if isinstance(v, float) and np.isnan(v) else v
+        attributes['endpoint_sn'] = int(attributes['endpoint_sn']) if attributes['endpoint_sn'].isdigit() else None
+        rows.append({'attributes': attributes})
+    return rows
@@ -0,0 +1,84 @@
+#Purpose: Keeps a local copy of every meter's monthly gpm values so the averages are only recalculated and sent for the
+#meters that got a new value this run instead of the whole layer
+
+
+import sqlite3
+import threading
+import numpy as np
+from meter_stats import MONTH_FIELDS
+
+
+#sqlite store of the twelve monthly values of each meter on the layer, keyed by objectid. meters whose values were
+#written since the averages were last sent are marked as touched. the store is seeded from the layer the first time the
+#averages are run with it
+class AggregateStore:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        columns = ', '.join(f'{m} REAL' for m in MONTH_FIELDS)
+        self.db.executescript(f'''
+            CREATE TABLE IF NOT EXISTS months (
+                objectid INTEGER PRIMARY KEY,
+                {columns},
+                touched INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                name TEXT PRIMARY KEY,
+                value TEXT
+            );
+        ''')
+        self.db.commit()
+
+    @property
+    def seeded(self):
+        with self.lock:
+            row = self.db.execute("SELECT 1 FROM meta WHERE name = 'seeded'").fetchone()
+        return row is not None
+
+    #replace the store with the monthly values loaded from the layer, nothing is touched afterwards
+    def seed(self, oids, months):
+        rows = [[int(o)] + [None if np.isnan(v) else float(v) for v in m] for o, m in zip(oids, months)]
+        with self.lock:
+            self.db.execute('DELETE FROM months')
+            self.db.executemany(f'INSERT INTO months VALUES ({", ".join("?" * 13)}, 0)', rows)
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('seeded', '1')")
+            self.db.commit()
+
+    #record the month values written by the model update. edits are (objectid, month field, gpm, reset), a reset
+    #clears the meter's other months first like reset_model does on the layer. a month that already has a value is
+    #replaced
+    def record(self, edits):
+        with self.lock:
+            for oid, field, gpm, reset in edits:
+                self.db.execute('INSERT OR IGNORE INTO months (objectid) VALUES (?)', (oid,))
+                if reset:
+                    self.db.execute(f'UPDATE months SET {" = NULL, ".join(MONTH_FIELDS)} = NULL WHERE objectid = ?',
+                                    (oid,))
+                if field in MONTH_FIELDS:
+                    self.db.execute(f'UPDATE months SET {field} = ? WHERE objectid = ?', (gpm, oid))
+                self.db.execute('UPDATE months SET touched = 1 WHERE objectid = ?', (oid,))
+            self.db.commit()
+
+    #replace every month of these meters, used when the monthly values are recalculated from the flow table
+    def replace(self, oids, months):
+        rows = [[int(o)] + [None if np.isnan(v) else float(v) for v in m] for o, m in zip(oids, months)]
+        with self.lock:
+            self.db.executemany(f'INSERT OR REPLACE INTO months VALUES ({", ".join("?" * 13)}, 1)', rows)
+            self.db.commit()
+
+    #the objectids and (meters x 12) monthly values of the touched meters, missing months are nan
+    def touched(self):
+        with self.lock:
+            rows = self.db.execute(
+                f'SELECT objectid, {", ".join(MONTH_FIELDS)} FROM months WHERE touched = 1'
+            ).fetchall()
+        oids = np.array([r[0] for r in rows], dtype=np.int64)
+        months = np.array([[np.nan if v is None else v for v in r[1:]] for r in rows], dtype=np.float64)
+        return oids, months.reshape(len(rows), 12)
+
+    #the averages of these meters were sent
+    def clear(self, oids):
+        with self.lock:
+            self.db.executemany('UPDATE months SET touched = 0 WHERE objectid = ?', [(int(o),) for o in oids])
+            self.db.commit()
@@ -0,0 +1,199 @@
+#Purpose: Loads the meter layer once and matches beacon rows to existing meters locally instead of querying the portal
+#for every row
+
+
+import math
+import threading
+import zlib
+from types import SimpleNamespace
+from gis_edits import corrected_xy, layer_wkid, query_all
+from records import to_int
+
+
+#the fields update_model needs to match meters and edit them
+INDEX_FIELDS = 'objectid,endpoint_sn,location_address'
+
+
+#addresses are compared ignoring case and extra whitespace
+def normalize_address(address):
+    if address is None:
+        return None
+    return ' '.join(str(address).split()).upper()
+
+
+#uniform grid of points in the layer's coordinates. with cells the size of the search distance a lookup only has to
+#look at the cell the point is in and the eight around it
+class SpatialGrid:
+    def __init__(self, cell):
+        self.cell = cell
+        self.cells = {}
+
+    def key(self, x, y):
+        return math.floor(x / self.cell), math.floor(y / self.cell)
+
+    def add(self, feature, x, y):
+        self.cells.setdefault(self.key(x, y), []).append((x, y, feature))
+
+    #the features within distance of the point
+    def within(self, x, y, distance):
+        cx, cy = self.key(x, y)
+        reach = math.ceil(distance / self.cell)
+        found = []
+        for i in range(cx - reach, cx + reach + 1):
+            for j in range(cy - reach, cy + reach + 1):
+                for px, py, feature in self.cells.get((i, j), ()):
+                    if (px - x) ** 2 + (py - y) ** 2 <= distance ** 2:
+                        found.append(feature)
+        return found
+
+
+#in memory index of the meter layer keyed by serial number and by address. with a tolerance the meters' locations are
+#indexed too, and a row that doesn't match by either one matches the meter within tolerance of its service point
+class MeterIndex:
+    def __init__(self, tolerance=None, wkid=None):
+        self.by_sn = {}
+        self.by_address = {}
+        self.order = {}
+        #the keys each feature is filed under so it can be moved when it's edited
+        self.keys = {}
+        self.created = 0
+        #the features a row of this run matches by serial number or address, the location match never takes them
+        self.claimed = set()
+        #update_model shards share one index, reentrant since reindex and add_created call add
+        self.lock = threading.RLock()
+        #tolerance is in the layer's units, wkid is the layer's spatial reference the service points are projected to
+        self.tolerance = tolerance
+        self.wkid = wkid
+        self.grid = SpatialGrid(tolerance) if tolerance else None
+
+    #page through the whole layer fetching only the fields that are needed, one query per page instead of per row
+    @classmethod
+    def load(cls, layer, out_fields=INDEX_FIELDS, page_size=2000, return_geometry=False, tolerance=None):
+        index = cls(tolerance, layer_wkid(layer) if tolerance else None)
+        for f in query_all(layer, out_fields, page_size, return_geometry or index.grid is not None):
+            index.add(f)
+            if index.grid is not None and f.geometry and f.geometry.get('x') is not None:
+                index.grid.add(f, f.geometry['x'], f.geometry['y'])
+
+        return index
+
+    def add(self, feature):
+        with self.lock:
+            self._add(feature)
+
+    def _add(self, feature):
+        attributes = feature.attributes
+        #features are ranked in the order they were added, which is objectid order when loaded from the layer
+        self.order.setdefault(id(feature), len(self.order))
+
+        sn = to_int(attributes.get('endpoint_sn'))
+        if sn is not None:
+            self.by_sn.setdefault(sn, []).append(feature)
+        address = normalize_address(attributes.get('location_address'))
+        if address is not None:
+            self.by_address.setdefault(address, []).append(feature)
+        self.keys[id(feature)] = (sn, address)
+
+    #move a feature to its current serial number and address after it's been edited, like the portal would. the row
+    #that edited it owns it now so it's claimed too
+    def reindex(self, feature):
+        with self.lock:
+            self.claimed.add(id(feature))
+            sn, address = self.keys.get(id(feature), (None, None))
+            for key, key_map in ((sn, self.by_sn), (address, self.by_address)):
+                features = key_map.get(key, [])
+                key_map[key] = [f for f in features if f is not feature]
+                if not key_map[key]:
+                    del key_map[key]
+            self._add(feature)
+
+    #track a meter built this run so a later row for the same meter edits it instead of building it again. the site is
+    #the dictionary passed to edit_features, wrapping it keeps it the same object the edits are made to. it only
+    #matches by serial number or address, not by location, so a second new meter at the same point gets its own site
+    def add_created(self, site):
+        feature = SimpleNamespace(attributes=site['attributes'], geometry=site.get('geometry'))
+        with self.lock:
+            self._add(feature)
+            self.created += 1
+        return feature
+
+    #the features that match the address or serial number, in the order they were added
+    def exact(self, address, sn=None):
+        sn = to_int(sn)
+        matches = list(self.by_address.get(normalize_address(address), []))
+        if sn is not None:
+            matches += self.by_sn.get(sn, [])
+        return sorted(matches, key=lambda f: self.order[id(f)])
+
+    #mark the meters the reads match by serial number or address before any of them is matched by location, so a row
+    #for a new meter next to one of them can't take it over before its own row gets to it
+    def claim(self, reads):
+        with self.lock:
+            for d in reads:
+                self.claimed.update(id(f) for f in self.exact(d.address, d.sn))
+
+    #same semantics as the where clause "location_address = address OR endpoint_sn = sn", the first feature that
+    #matches either one is returned. if neither matches and point is the row's service point from positions, the meter
+    #within tolerance of it is returned, but only if there's exactly one so side by side meters aren't merged. meters
+    #claimed by another row are left out of the location match. otherwise None
+    def match(self, address, sn=None, point=None):
+        with self.lock:
+            matches = self.exact(address, sn)
+            if matches:
+                return matches[0]
+            if self.grid is not None and point is not None:
+                nearby = [f for f in self.grid.within(point[0], point[1], self.tolerance)
+                          if id(f) not in self.claimed]
+                if len(nearby) == 1:
+                    return nearby[0]
+            return None
+
+    #the service points of the rows in layer coordinates with the master layer offset, for the rows that don't match
+    #by serial number or address yet. all of them are projected in one call, the others are None
+    def positions(self, reads):
+        points = [None] * len(reads)
+        if self.grid is None:
+            return points
+
+        need = [i for i, d in enumerate(reads)
+                if d.longitude is not None and d.latitude is not None and self.match(d.address, d.sn) is None]
+        xs, ys = corrected_xy([reads[i].longitude for i in need], [reads[i].latitude for i in need], self.wkid)
+        for i, x, y in zip(need, xs.tolist(), ys.tolist()):
+            points[i] = (x, y)
+        return points
+
+
+#split the monthly reads into shards that can be updated at the same time. rows that share a serial number or an
+#address, or that match the same meter on the layer, could touch the same feature so they always land in the same
+#shard, in their original order. that keeps the march reset before the edit and stops two shards building one meter
+def partition(rows, index, shards):
+    parent = {}
+
+    def find(k):
+        parent.setdefault(k, k)
+        while parent[k] != k:
+            parent[k] = parent[parent[k]]
+            k = parent[k]
+        return k
+
+    def union(keys):
+        keys = [find(k) for k in keys if k[1] is not None]
+        for k in keys[1:]:
+            parent[k] = keys[0]
+
+    groups = []
+    for d, point in zip(rows, index.positions(rows)):
+        keys = [('sn', to_int(d.sn)), ('address', normalize_address(d.address))]
+        feature = index.match(d.address, d.sn, point)
+        if feature is not None:
+            keys += [('sn', to_int(feature.attributes.get('endpoint_sn'))),
+                     ('address', normalize_address(feature.attributes.get('location_address')))]
+        union(keys)
+        groups.append([k for k in keys if k[1] is not None])
+
+    split = [[] for _ in range(shards)]
+    for d, keys in zip(rows, groups):
+        #rows with neither a serial number nor an address can't match anything
+        root = find(keys[0]) if keys else ('row', id(d))
+        split[zlib.crc32(repr(root).encode()) % shards].append(d)
+    return split
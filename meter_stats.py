@@ -0,0 +1,156 @@
+#Purpose: Calculates the monthly flow statistics for every meter at once with numpy instead of looping over features
+
+
+import calendar
+import datetime as dt
+import numpy as np
+from gis_edits import EditBatcher, query_all
+
+
+#the monthly average gpm fields on the meter layer, january to december
+MONTH_FIELDS = [f'{m}_gpm'.lower() for m in calendar.month_name[1:]]
+#the aggregate fields calculated from the monthly values
+STAT_FIELDS = ['annual_avg', 'summer_flow', 'peak_flow']
+#minutes in an average month, monthly flow divided by this is the average gpm
+MONTH_MINUTES = 30.437 * 24 * 60
+
+
+#None becomes nan so missing months can be skipped
+def to_array(values):
+    return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+
+
+#annual average, summer (july to september) average and peak of an (meters x 12 months) array of gpm values. missing
+#months are nan and are left out of the averages. like the per feature loop this replaced, a meter with no annual or
+#no summer values gets 0 for both averages, and the peak is never below 0
+def aggregate(months):
+    present = ~np.isnan(months)
+    values = np.where(present, months, 0.0)
+
+    n_annual = present.sum(axis=1)
+    n_summer = present[:, 6:9].sum(axis=1)
+    ok = (n_annual > 0) & (n_summer > 0)
+
+    annual = np.where(ok, values.sum(axis=1) / np.maximum(n_annual, 1), 0.0)
+    summer = np.where(ok, values[:, 6:9].sum(axis=1) / np.maximum(n_summer, 1), 0.0)
+    peak = np.max(values, axis=1, initial=0.0)
+
+    return annual, summer, peak
+
+
+#True where the new values differ from the old ones, nan counts as equal to nan
+def changed(old, new):
+    same = np.isclose(old, new, rtol=1e-9, atol=1e-12) | (np.isnan(old) & np.isnan(new))
+    return ~same
+
+
+#the month (1-12) of each flow_time timestamp in local time, or 0 if it is missing. there are only a few distinct
+#timestamps in the flow table so each one is converted once
+def months_of(flow_times):
+    stamps = to_array(flow_times)
+    unique, inverse = np.unique(stamps, return_inverse=True)
+    months = np.array([0 if np.isnan(u) else dt.datetime.fromtimestamp(u * 10 ** -3).month for u in unique],
+                      dtype=np.int64)
+    return months[inverse.reshape(-1)]
+
+
+#monthly gpm and aggregate values for every meter on the layer as arrays, loaded with one paged query
+class MeterStats:
+    def __init__(self, oids, sns, months, stats):
+        self.oids = oids
+        self.sns = sns
+        self.months = months
+        self.original_months = months.copy()
+        self.stats = stats
+        self.original_stats = [s.copy() for s in stats]
+
+    @classmethod
+    def load(cls, layer, page_size=2000):
+        fields = ','.join(['objectid', 'endpoint_sn'] + MONTH_FIELDS + STAT_FIELDS)
+        features = query_all(layer, fields, page_size)
+
+        oids = np.array([f.attributes['objectid'] for f in features], dtype=np.int64)
+        sns = [f.attributes.get('endpoint_sn') for f in features]
+        months = np.array([to_array([f.attributes.get(m) for m in MONTH_FIELDS]) for f in features],
+                          dtype=np.float64).reshape(len(features), 12)
+        stats = [to_array([f.attributes.get(s) for f in features]) for s in STAT_FIELDS]
+
+        return cls(oids, sns, months, stats)
+
+    #meters whose monthly values are already known, like the ones kept in the aggregate store. the aggregates start
+    #out missing so every meter is sent once they're calculated
+    @classmethod
+    def from_months(cls, oids, months):
+        n = len(oids)
+        return cls(oids, [None] * n, months, [np.full(n, np.nan) for _ in STAT_FIELDS])
+
+    #fill in the monthly gpm values from the flow table, joined to the meters on endpoint_sn. if a meter has more than
+    #one row for a month the latest one is used. months without a row keep the value they have. every feature with
+    #the serial number gets the values, the layer has a few meters that are on it more than once
+    def apply_flow_table(self, table, page_size=2000):
+        rows = query_all(table, 'endpoint_sn,flow,flow_time', page_size)
+        serials = {}
+        group = np.array([-1 if sn is None else serials.setdefault(sn, len(serials)) for sn in self.sns],
+                         dtype=np.int64)
+
+        meter = np.array([serials.get(r.attributes.get('endpoint_sn'), -1) for r in rows], dtype=np.int64)
+        flow = to_array([r.attributes.get('flow') for r in rows])
+        flow_times = to_array([r.attributes.get('flow_time') for r in rows])
+        month = months_of(flow_times)
+
+        keep = (meter >= 0) & (month > 0) & ~np.isnan(flow)
+        meter, flow, flow_times, month = meter[keep], flow[keep], flow_times[keep], month[keep]
+
+        #sort by time and keep the last row for each serial number and month
+        order = np.argsort(flow_times, kind='stable')[::-1]
+        cell = meter[order] * 12 + (month[order] - 1)
+        cell, first = np.unique(cell, return_index=True)
+        values = np.full((len(serials), 12), np.nan)
+        np.put(values, cell, flow[order][first] / MONTH_MINUTES)
+
+        #then copy them to the features with that serial number
+        joined = group >= 0
+        found = values[group[joined]]
+        self.months[joined] = np.where(np.isnan(found), self.months[joined], found)
+
+    #fill in one month's gpm values worked out somewhere else, like the local flow store, as {endpoint_sn: gpm}. only
+    #months that don't have a value yet are filled
+    def fill_month(self, month, values):
+        for i, sn in enumerate(self.sns):
+            if sn in values and np.isnan(self.months[i, month - 1]):
+                self.months[i, month - 1] = values[sn]
+
+    #True for the meters whose monthly values changed
+    def changed_months(self):
+        return changed(self.original_months, self.months).any(axis=1)
+
+    #recalculate the aggregate fields from the monthly values
+    def calculate(self):
+        self.stats = list(aggregate(self.months))
+
+    #the update for every meter with a value that changed, only the changed meters are sent
+    def updates(self, month_values=True, stat_values=True):
+        n = len(self.oids)
+        dirty = np.zeros(n, dtype=bool)
+        fields = []
+        if month_values:
+            dirty |= self.changed_months()
+            fields += [(m, self.months[:, i]) for i, m in enumerate(MONTH_FIELDS)]
+        if stat_values:
+            for old, new in zip(self.original_stats, self.stats):
+                dirty |= changed(old, new)
+            fields += list(zip(STAT_FIELDS, self.stats))
+
+        updates = []
+        for i in np.flatnonzero(dirty):
+            attributes = {'objectid': int(self.oids[i])}
+            for name, values in fields:
+                attributes[name] = None if np.isnan(values[i]) else float(values[i])
+            updates.append({'attributes': attributes})
+        return updates
+
+    #send the changed meters to the layer in chunks, returns the chunks that had failures
+    def write(self, layer, chunk_size=1000, month_values=True, stat_values=True):
+        edits = EditBatcher(layer, chunk_size)
+        edits.edit_features(updates=self.updates(month_values, stat_values))
+        return edits.flush()
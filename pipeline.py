@@ -0,0 +1,101 @@
+#Purpose: Runs the steps of the monthly update at the same time, connected by bounded queues, so the portal writes
+#start while the beacon report is still downloading
+
+
+import queue
+import threading
+import time
+from instrumentation import metrics
+
+
+#marks the end of the items in a queue
+DONE = object()
+
+
+#raised by the consumer when a stage before it failed, the stage's error is the cause
+class PipelineError(Exception):
+    pass
+
+
+#each stage runs in its own thread and reads from the queue of the stage before it, the first one reads from source.
+#stages are (name, function) pairs, the function is applied to every item and an item it returns None for is dropped.
+#the queues hold at most maxsize items so a fast stage waits for a slow one instead of filling memory. iterating the
+#pipeline gives the items out of the last stage, use it in a with block so the threads are stopped if the consumer
+#fails. if a stage fails every stage stops and the consumer raises PipelineError
+class Pipeline:
+    def __init__(self, source, stages=(), maxsize=1000, poll=0.5):
+        self.stop = threading.Event()
+        self.errors = []
+        self.poll = poll
+        self.threads = []
+
+        inbox = None
+        for name, function in [('source', None)] + list(stages):
+            outbox = queue.Queue(maxsize)
+            thread = threading.Thread(target=metrics.carry(self.work), args=(name, source, inbox, function, outbox),
+                                      name=f'pipeline {name}', daemon=True)
+            self.threads.append(thread)
+            inbox = outbox
+        self.output = inbox
+
+    def __enter__(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        for thread in self.threads:
+            thread.join(self.poll * 4)
+
+    def __iter__(self):
+        for item in self.drain(self.output):
+            yield item
+        if self.errors:
+            raise PipelineError(f'pipeline stage failed: {self.errors[0]!r}') from self.errors[0]
+
+    #the loop run by each stage's thread
+    def work(self, name, source, inbox, function, outbox):
+        items = source if inbox is None else self.drain(inbox)
+        try:
+            for item in items:
+                if function is not None:
+                    item = function(item)
+                    if item is None:
+                        continue
+                if not self.put(name, outbox, item):
+                    break
+        except Exception as e:
+            self.errors.append(e)
+            self.stop.set()
+        finally:
+            #closing the source stops a download that is still streaming
+            if hasattr(items, 'close'):
+                items.close()
+            self.put(name, outbox, DONE)
+
+    #put an item on the queue, waiting while it's full. False if the pipeline was stopped while waiting
+    def put(self, name, outbox, item):
+        start = time.perf_counter()
+        while not self.stop.is_set():
+            try:
+                outbox.put(item, timeout=self.poll)
+            except queue.Full:
+                continue
+            waited = time.perf_counter() - start
+            #time spent waiting on the next stage, a stage that waits a lot is ahead of the one after it
+            if waited > self.poll:
+                metrics.observe(f'pipeline {name} backpressure', waited)
+            return True
+        return False
+
+    #the items on a queue until the stage before it is done or the pipeline is stopped
+    def drain(self, inbox):
+        while not self.stop.is_set():
+            try:
+                item = inbox.get(timeout=self.poll)
+            except queue.Empty:
+                continue
+            if item is DONE:
+                return
+            yield item
@@ -0,0 +1,121 @@
+#Purpose: One shared login to the portal for the whole run, with the hosted items and their layers cached so every
+#function doesn't sign in and look them up again
+
+
+import threading
+import time
+from arcgis import GIS
+from instrumentation import metrics
+
+
+PORTAL_URL = 'https://esriapps1.esriwadc.com/portal'
+#hosted water meter model, one feature layer and one flow table
+MODEL_ITEM = 'bba03d3af8b849848a9691b9042598be'
+#hosted badger meter data, the hourly flow table
+BADGER_ITEM = '62e76f6d62d543c0ad5c4954e2156efd'
+
+#pieces of the error messages the portal gives when the token has expired
+TOKEN_ERRORS = ('invalid token', 'token required', 'token expired', 'error code: 498', 'error code: 499')
+
+
+#True if the exception is the portal rejecting an expired token
+def token_expired(e):
+    message = str(e).lower()
+    return any(t in message for t in TOKEN_ERRORS)
+
+
+#lazily signs in to the portal and caches the items looked up by id. the login is renewed after token_ttl seconds or
+#when the portal says the token expired
+class PortalConnection:
+    def __init__(self, username, password, url=PORTAL_URL, token_ttl=50 * 60):
+        self.url = url
+        self.username = username
+        self.password = password
+        self.token_ttl = token_ttl
+        self.lock = threading.RLock()
+        self._gis = None
+        self.signed_in = 0.0
+        self.items = {}
+        self.logins = 0
+
+    @property
+    def gis(self):
+        with self.lock:
+            if self._gis is None or time.monotonic() - self.signed_in > self.token_ttl:
+                with metrics.timer('gis login'):
+                    self._gis = GIS(self.url, self.username, self.password)
+                self.signed_in = time.monotonic()
+                self.items = {}
+                self.logins += 1
+            return self._gis
+
+    #sign in again the next time the portal is used
+    def refresh(self):
+        with self.lock:
+            self._gis = None
+
+    def item(self, item_id):
+        gis = self.gis
+        with self.lock:
+            if item_id not in self.items:
+                with metrics.timer('gis item'):
+                    self.items[item_id] = gis.content.get(item_id)
+            return self.items[item_id]
+
+    #handle for a feature layer in a hosted item that stays good after the login is renewed
+    def layer(self, item_id, index=0):
+        return LayerHandle(self, item_id, 'layers', index)
+
+    #handle for a table in a hosted item that stays good after the login is renewed
+    def table(self, item_id, index=0):
+        return LayerHandle(self, item_id, 'tables', index)
+
+    #run a portal call, if the token expired sign in again and try it once more
+    def call(self, func, *args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if not token_expired(e):
+                raise
+            self.refresh()
+            return func(*args, **kwargs)
+
+
+#stands in for a layer or table of a hosted item. the layer is looked up through the connection every time it's used so
+#a renewed login is picked up, and calls that fail with an expired token are retried after signing in again
+class LayerHandle:
+    def __init__(self, connection, item_id, kind, index):
+        self.connection = connection
+        self.item_id = item_id
+        self.kind = kind
+        self.index = index
+
+    def resolve(self):
+        return getattr(self.connection.item(self.item_id), self.kind)[self.index]
+
+    def __getattr__(self, name):
+        attribute = getattr(self.resolve(), name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            return self.connection.call(lambda: getattr(self.resolve(), name)(*args, **kwargs))
+        return call
+
+
+#one connection per portal login for the whole process
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+#get the shared connection for the GIS section of the config file, shared=False gives a connection of its own
+def get_connection(g, shared=True):
+    url = g.get('portal_url', PORTAL_URL)
+    if not shared:
+        return PortalConnection(g['username'], g['password'], url)
+
+    key = (url, g['username'])
+    with _connections_lock:
+        if key not in _connections:
+            _connections[key] = PortalConnection(g['username'], g['password'], url)
+        return _connections[key]
@@ -0,0 +1,35 @@
+#Purpose: Token bucket rate limiter shared by the threads calling beacon or the portal so they stay under the rate
+#limits
+
+
+import threading
+import time
+
+
+#thread safe token bucket. rate is requests per second and capacity is how many can go out back to back before it
+#starts making callers wait
+class TokenBucket:
+    def __init__(self, rate=1.0, capacity=5):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    #block until a token is available and take it
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+#make a limiter from a section of the config file, rate_limit is requests per second and rate_burst is the capacity
+def rate_limiter(section, rate=1.0, burst=5):
+    return TokenBucket(float(section.get('rate_limit', rate)), int(section.get('rate_burst', burst)))
@@ -0,0 +1,89 @@
+#Purpose: Parses the rows of a beacon monthly report once into compact typed records so the model update doesn't convert
+#the same strings over and over
+
+
+import calendar
+import datetime as dt
+import sys
+from functools import lru_cache
+from meter_stats import MONTH_MINUTES
+
+
+#the same few month strings show up on every row so each one is only parsed once
+@lru_cache(maxsize=None)
+def parse_month(text):
+    try:
+        return dt.datetime.strptime(text, '%Y-%m')
+    except (ValueError, TypeError):
+        return None
+
+
+def to_float(value, default=None):
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return default
+
+
+def to_int(value):
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return None
+
+
+#strings that repeat on most rows, like the city or read method, share one copy
+def shared(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+#one meter's row of the monthly audit with its values already converted. a missing or bad flow is 0 like the old per
+#row conversion, a missing serial number, time or location is None
+class MonthlyRead:
+    __slots__ = ('sn', 'account_id', 'account_full_name', 'address', 'city', 'endpoint_type', 'read_method', 'flow',
+                 'flow_time', 'sa_start_date', 'latitude', 'longitude')
+
+    def __init__(self, sn, account_id, account_full_name, address, city, endpoint_type, read_method, flow, flow_time,
+                 sa_start_date, latitude, longitude):
+        self.sn = sn
+        self.account_id = account_id
+        self.account_full_name = account_full_name
+        self.address = address
+        self.city = city
+        self.endpoint_type = endpoint_type
+        self.read_method = read_method
+        self.flow = flow
+        self.flow_time = flow_time
+        self.sa_start_date = sa_start_date
+        self.latitude = latitude
+        self.longitude = longitude
+
+    #build a record from one row of the beacon report
+    @classmethod
+    def parse(cls, d):
+        return cls(
+            to_int(d.get('Endpoint_SN')),
+            d.get('Account_ID'),
+            d.get('Account_Full_Name'),
+            d.get('Location_Address_Line1'),
+            shared(d.get('Location_City')),
+            shared(d.get('Endpoint_Type')),
+            shared(d.get('Read_Method')),
+            to_float(d.get('Flow'), 0),
+            parse_month(d.get('Flow_Time')),
+            parse_month(d.get('SA_Start_Date')),
+            to_float(d.get('Service_Point_Latitude')),
+            to_float(d.get('Service_Point_Longitude'))
+        )
+
+    #the model field the month's value goes in, like june_gpm, or None if the row has no time
+    @property
+    def month_field(self):
+        if self.flow_time is None:
+            return None
+        return f'{calendar.month_name[self.flow_time.month]}_gpm'.lower()
+
+    @property
+    def gpm(self):
+        return self.flow / MONTH_MINUTES
+
@@ -0,0 +1,38 @@
+#Purpose: Checks that the local flow store only counts the hours beacon reported a flow for
+
+
+import datetime as dt
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flow_ingest import flow_columns, reported_flow
+from flow_store import FlowStore
+
+
+#one hourly route record the way collect_all returns it
+def hourly(sn, when, flow):
+    return {'Account_Full_Name': 'Customer', 'Endpoint_SN': str(sn), 'Endpoint_Type': 'Water', 'Flow_Unit': 'Gallons',
+            'Location_Address_Line1': f'{sn} Route 21 Rd', 'Battery_Level': '90', 'Flow': flow,
+            'Current_Leak_Rate': None, 'Backflow_Gallons': None, 'Current_Leak_Start_Date': None,
+            'Flow_Time': f'{when:%Y-%m-%d %H:%M}'}
+
+
+class FlowStoreTest(unittest.TestCase):
+    #meter 1 reported every hour of june, meter 2 is in the report for every hour but never had a read
+    def test_hours_without_a_read_are_not_counted(self):
+        hours = [dt.datetime(2024, 6, 1) + dt.timedelta(hours=h) for h in range(30 * 24)]
+        store = {'21': [hourly(1, h, 2.0) for h in hours] + [hourly(2, h, None) for h in hours]}
+
+        flows = FlowStore()
+        added = flows.ingest(flow_columns(store), reported_flow(store))
+
+        self.assertEqual(added, len(hours))
+        self.assertEqual(flows.month_totals('2024-06'), {1: (2.0 * len(hours), len(hours))})
+        self.assertEqual(list(flows.monthly_gpm('2024-06')), [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
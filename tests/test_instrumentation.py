@@ -0,0 +1,44 @@
+#Purpose: Checks that calls made on other threads are counted under the right stage of the run
+
+
+import os
+import sys
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from instrumentation import Metrics
+
+
+class StageTest(unittest.TestCase):
+    #an export started in the backfill stage keeps counting under it while the main thread moves on to a month's update
+    def test_stage_is_per_thread(self):
+        metrics = Metrics()
+        started = threading.Event()
+        updating = threading.Event()
+
+        def export():
+            started.set()
+            updating.wait(5)
+            with metrics.timer('beacon export'):
+                pass
+
+        with metrics.stage('backfill'):
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                future = pool.submit(metrics.carry(export))
+                started.wait(5)
+                with metrics.stage('update_model 2024-01'):
+                    with metrics.timer('gis update'):
+                        updating.set()
+                        future.result()
+
+        calls = metrics.report()['calls']
+        self.assertEqual(list(calls['backfill']), ['beacon export'])
+        self.assertEqual(list(calls['update_model 2024-01']), ['gis update'])
+        self.assertEqual(metrics.current, 'run')
+
+
+if __name__ == '__main__':
+    unittest.main()
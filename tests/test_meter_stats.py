@@ -0,0 +1,37 @@
+#Purpose: Checks that the monthly values from the flow table reach every meter they belong to
+
+
+import os
+import sys
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from fake_gis import FakeLayer
+from meter_stats import MONTH_MINUTES, MeterStats
+
+
+class ApplyFlowTableTest(unittest.TestCase):
+    #serial number 5 is on the layer twice, both features get its flow. a month with no row keeps its value
+    def test_duplicate_serial_numbers(self):
+        layer = FakeLayer(latency=0)
+        for sn in (5, 6, 5):
+            layer.insert({'endpoint_sn': sn, 'january_gpm': 1.0})
+        table = FakeLayer(latency=0)
+        june = time.mktime((2024, 6, 1, 0, 0, 0, 0, 0, -1)) * 10 ** 3
+        for sn, flow in ((5, 1000.0), (6, 2000.0)):
+            table.insert({'endpoint_sn': sn, 'flow': flow, 'flow_time': june})
+
+        stats = MeterStats.load(layer)
+        stats.apply_flow_table(table)
+
+        june_gpm = [1000 / MONTH_MINUTES, 2000 / MONTH_MINUTES, 1000 / MONTH_MINUTES]
+        self.assertEqual(stats.months[:, 5].tolist(), june_gpm)
+        self.assertEqual(stats.months[:, 0].tolist(), [1.0, 1.0, 1.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+#Purpose: Checks that the sliced monthly audit only exports the slices that failed again
+
+
+import datetime as dt
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import beacon_api_functions as bapi
+
+
+class SlicedAuditTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = bapi.monthly_meter_audit, bapi.poll_status, bapi.iter_report
+        self.polls = []
+        bapi.monthly_meter_audit = lambda s_time, e_time, bcon, client, route: {'edsUUID': f'{s_time:%Y-%m}'}
+        bapi.poll_status = self.poll_status
+        bapi.iter_report = lambda status, bcon, client: iter([{'Endpoint_SN': '1', 'Flow_Time': status['month']}])
+
+    def tearDown(self):
+        bapi.monthly_meter_audit, bapi.poll_status, bapi.iter_report = self.saved
+
+    #february's export ends in beacon's exception state the first time it runs
+    def poll_status(self, raw, bcon, client=None, strategy=None, kind=None, expected=None):
+        self.polls.append(raw['edsUUID'])
+        if raw['edsUUID'] == '2024-02' and self.polls.count('2024-02') == 1:
+            raise bapi.ExportFailed('Something went wrong with the data export!')
+        return {'state': 'done', 'month': raw['edsUUID']}
+
+    def test_failed_export_is_run_again(self):
+        records = bapi.sliced_audit(dt.datetime(2024, 1, 1), dt.datetime(2024, 3, 31, 23, 59, 59), {},
+                                    client=object(), slice_months=1)
+
+        self.assertEqual(sorted(r['Flow_Time'] for r in records), ['2024-01', '2024-02', '2024-03'])
+        self.assertEqual(sorted(self.polls), ['2024-01', '2024-02', '2024-02', '2024-03'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+#Purpose: Checks that the model update only journals the meters whose edits made it to the portal and matches the rows
+#to the right meters
+
+
+import datetime as dt
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import beacon_api_functions as bapi
+from checkpoint import RunJournal
+from meter_aggregates import AggregateStore
+from fake_gis import FakeConnection, FakeItem, FakeLayer, fake_model
+from gis_edits import X_OFFSET, Y_OFFSET
+
+
+#a fake layer that rejects the adds or updates whose attributes reject returns True for
+class RejectingLayer(FakeLayer):
+    def __init__(self, layer, reject):
+        self.__dict__.update(layer.__dict__)
+        self.reject = reject
+
+    def edit_features(self, adds=None, updates=None):
+        result = super().edit_features(adds=[a for a in adds or [] if not self.reject(a['attributes'])],
+                                       updates=[u for u in updates or [] if not self.reject(u['attributes'])])
+        for operation, features in (('add', adds), ('update', updates)):
+            results = iter(result[f'{operation}Results'])
+            result[f'{operation}Results'] = [
+                {'success': False, 'error': {'description': 'rejected'}} if self.reject(f['attributes'])
+                else next(results) for f in features or []
+            ]
+        return result
+
+
+def audit_row(sn):
+    return {'Endpoint_SN': str(sn), 'Location_Address_Line1': f'{100 + sn % 9000} Route 21 Rd', 'Flow': '1000',
+            'Flow_Time': '2024-06', 'Read_Method': 'Network'}
+
+
+class UpdateModelJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.get_connection = bapi.get_connection
+
+    def tearDown(self):
+        bapi.get_connection = self.get_connection
+
+    #the table add of the first meter fails in the first chunk and the geometry update of the last meter fails in the
+    #second chunk, neither meter can be marked as processed
+    def test_failure_in_later_chunk_is_not_journaled(self):
+        model = fake_model(4, latency=0)
+        model.tables[0] = RejectingLayer(model.tables[0], lambda a: a.get('endpoint_sn') == 100000000)
+        last = next(oid for oid, a in model.layers[0].rows.items() if a['endpoint_sn'] == 100000003)
+        model.layers[0] = RejectingLayer(model.layers[0], lambda a: a.get('objectid') == last)
+        connection = FakeConnection({bapi.MODEL_ITEM: model})
+        bapi.get_connection = lambda g, shared=True: connection
+
+        journal = RunJournal(':memory:')
+        aggregates = AggregateStore(':memory:')
+        data = ([audit_row(100000000 + m) for m in range(4)], dt.datetime(2024, 6, 1))
+        result = bapi.update_model(data, dt.datetime(2024, 8, 1), {}, chunk_size=2, journal=journal,
+                                   aggregates=aggregates)
+
+        self.assertEqual(len(result['failures']), 2)
+        self.assertEqual(journal.processed('2024-06'), {'100000001', '100000002'})
+        #the month value of the meter whose update failed isn't on the layer so it isn't in the aggregate store
+        self.assertNotIn(last, aggregates.touched()[0].tolist())
+        self.assertEqual(len(aggregates.touched()[0]), 3)
+
+
+
+    #meters without a serial number each get their flow row, and one whose flow row is rejected isn't journaled
+    def test_rows_without_serial_numbers(self):
+        table = RejectingLayer(FakeLayer(latency=0), lambda a: a.get('flow') == 2.0)
+        layer = FakeLayer(latency=0, related=table)
+        connection = FakeConnection({bapi.MODEL_ITEM: FakeItem([layer], [table])})
+        bapi.get_connection = lambda g, shared=True: connection
+
+        journal = RunJournal(':memory:')
+        rows = [{'Location_Address_Line1': f'{m} NO SERIAL RD', 'Flow': str(m), 'Flow_Time': '2024-06'}
+                for m in range(3)]
+        result = bapi.update_model((rows, dt.datetime(2024, 6, 1)), dt.datetime(2024, 8, 1), {}, journal=journal)
+
+        self.assertEqual(sorted(r['flow'] for r in table.rows.values()), [0.0, 1.0])
+        self.assertEqual(len(result['failures']), 1)
+        self.assertEqual(journal.processed('2024-06'), {'address:0 NO SERIAL RD', 'address:1 NO SERIAL RD'})
+
+
+#a row of the monthly audit with a service point
+def located_row(sn, address, name, longitude=-86.8, latitude=35.9):
+    return {'Endpoint_SN': str(sn), 'Location_Address_Line1': address, 'Account_Full_Name': name, 'Flow': '1000',
+            'Flow_Time': '2024-06', 'Read_Method': 'Network', 'Service_Point_Longitude': str(longitude),
+            'Service_Point_Latitude': str(latitude)}
+
+
+class SpatialMatchTest(unittest.TestCase):
+    def setUp(self):
+        self.get_connection = bapi.get_connection
+        self.table = FakeLayer(latency=0)
+        self.layer = FakeLayer(latency=0, related=self.table)
+        connection = FakeConnection({bapi.MODEL_ITEM: FakeItem([self.layer], [self.table])})
+        bapi.get_connection = lambda g, shared=True: connection
+
+    def tearDown(self):
+        bapi.get_connection = self.get_connection
+
+    def update(self, rows):
+        data = (rows, dt.datetime(2024, 6, 1))
+        return bapi.update_model(data, dt.datetime(2024, 8, 1), {'match_tolerance': '0.001'},
+                                 journal=RunJournal(':memory:'))
+
+    def meters(self):
+        return sorted((a['endpoint_sn'], a['location_address'], a.get('account_full_name'))
+                      for a in self.layer.rows.values())
+
+    #a new meter sharing its service point with a meter another row matches by serial number builds its own feature
+    #instead of taking that meter over
+    def test_location_match_skips_meters_other_rows_match(self):
+        oid = self.layer.insert({'endpoint_sn': 1, 'location_address': '100 A ST', 'account_full_name': 'Alice',
+                                 'january_gpm': 0.5}, {'x': -86.8 + X_OFFSET, 'y': 35.9 + Y_OFFSET})
+        result = self.update([located_row(2, '100 B ST', 'Bob'), located_row(1, '100 A ST', 'Alice')])
+
+        self.assertEqual(self.meters(), [(1, '100 A ST', 'Alice'), (2, '100 B ST', 'Bob')])
+        #alice's history stays on her own feature
+        self.assertEqual(self.layer.rows[oid]['endpoint_sn'], 1)
+        self.assertEqual(self.layer.rows[oid]['january_gpm'], 0.5)
+        self.assertEqual(result['meters']['new'], 1)
+
+    #two new meters at the same point aren't merged into one
+    def test_new_meters_are_not_matched_by_location(self):
+        result = self.update([located_row(7, '10 UNIT A', 'Ann'), located_row(8, '10 UNIT B', 'Ben')])
+
+        self.assertEqual(self.meters(), [(7, '10 UNIT A', 'Ann'), (8, '10 UNIT B', 'Ben')])
+        self.assertEqual(result['meters']['new'], 2)
+
+    #an old meter with no row of its own next to two new ones goes to one of them, the other is built
+    def test_location_match_is_used_once(self):
+        self.layer.insert({'endpoint_sn': 1, 'location_address': '10 UNIT', 'account_full_name': 'Old'},
+                          {'x': -86.8 + X_OFFSET, 'y': 35.9 + Y_OFFSET})
+        result = self.update([located_row(7, '10 UNIT A', 'Ann'), located_row(8, '10 UNIT B', 'Ben')])
+
+        self.assertEqual(self.meters(), [(7, '10 UNIT A', 'Ann'), (8, '10 UNIT B', 'Ben')])
+        self.assertEqual(result['meters']['new'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
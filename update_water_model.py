@@ -3,32 +3,118 @@
 
 
 import beacon_api_functions as bapi
+import argparse
 import datetime as dt
+import os
+from concurrent.futures import ThreadPoolExecutor
+from instrumentation import metrics, profiled
+from pipeline import Pipeline
+from records import MonthlyRead
 
 
-def main():
-    # s_time = dt.datetime(2023, 1, 1)
-    # e_time = dt.datetime(2023, 7, 31)
-    num_months = [None, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]
-    #sets the start and end times to the whole month two months ago since that's the last period of full data
-    current_month = dt.datetime.now().replace(day=1, hour=0, minute=0, second=0)
-    last_month = (current_month - dt.timedelta(days=1)).replace(day=1)
-    # month_before = (last_month - dt.timedelta(days=1)).replace(day=1)
-    if current_month.month == 1 or current_month.month == 2:
-        s_time = current_month.replace(year=current_month.year - 1 ,month=num_months[current_month.month-3], day=1, hour=0, minute=0, second=0)
-    else:
-        s_time = current_month.replace(month=num_months[current_month.month - 2], day=1, hour=0, minute=0, second=0)
-    e_time = (last_month - dt.timedelta(days=1)).replace(hour=23, minute=59, second=59)
-    # e_time = (month_before - dt.timedelta(days=1)).replace(hour=23, minute=59, second=59)
+#the first of the month n months after (or before, if n is negative) the month of date
+def add_months(date, n):
+    years, month = divmod(date.month - 1 + n, 12)
+    return date.replace(year=date.year + years, month=month + 1, day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+#the start and end of the whole month of period, the range passed to the monthly audit
+def month_window(period):
+    s_time = add_months(period, 0)
+    e_time = add_months(period, 1) - dt.timedelta(seconds=1)
+    return s_time, e_time
+
+
+#the data for a period is read by beacon the month after, so it's loaded into the model two months later. the current
+#month decides things like the march reset
+def update_month(period):
+    return add_months(period, 2)
+
+
+#updates the model with one month of data. the export runs while the meter layer loads, then the report is read as it
+#downloads and each row is parsed and written while the next ones are still coming in
+def run_month(period, g, b):
+    s_time, e_time = month_window(period)
+    stages = [('parse', MonthlyRead.parse)]
+    with Pipeline(bapi.audit_records(s_time, e_time, b), stages, int(g.get('pipeline_queue_size', 1000))) as reads:
+        return bapi.update_model([reads, s_time, e_time], update_month(period), g)
+
+
+#updates the model with every month from start to end. the exports for all the months are requested at the same time
+#(backfill_workers at once, the beacon client keeps them under the rate limit) and the model is updated one month at a
+#time in order as they finish. each month is recorded in the journal when every row made it to the portal so a backfill
+#that stops can be run again and picks up at the first month that didn't finish. the exports share one cache so they
+#don't write over each other's manifests. the march archive is skipped, the model being rebuilt isn't last year's
+def backfill(start, end, g, b):
+    journal = bapi.run_journal(g)
+    periods = []
+    period = add_months(start, 0)
+    while period <= end:
+        if not journal.step_done('backfill', f'{period:%Y-%m}'):
+            periods.append(period)
+        period = add_months(period, 1)
+
+    results = {}
+    cache = bapi.export_cache(b)
+    with ThreadPoolExecutor(max_workers=int(b.get('backfill_workers', 4))) as pool:
+        #the exports are counted under the backfill stage, not the month the model update is on when they run
+        audit = metrics.carry(bapi.monthly_audit)
+        exports = {p: pool.submit(audit, *month_window(p), b, cache=cache) for p in periods}
+        for p in periods:
+            data = exports[p].result()
+            with metrics.stage(f'update_model {p:%Y-%m}'):
+                result = bapi.update_model(data, update_month(p), g, journal=journal, archive=False)
+            results[f'{p:%Y-%m}'] = result
+            #a month with failed edits or a shard that stopped is run again next time, the journal skips its done rows
+            if not result['failures'] and not result['errors']:
+                journal.mark_step('backfill', f'{p:%Y-%m}')
+
+    return results
+
+
+#the part of update_model's result that goes in the run report, the new, changed, unchanged and skipped meters and how
+#many chunks had failures. the failed features themselves are left out
+def run_summary(result):
+    return {'meters': result['meters'], 'failures': len(result['failures']), 'errors': result['errors']}
+
+
+#a month on the command line, like 2023-04
+def period_arg(text):
+    try:
+        return dt.datetime.strptime(text, '%Y-%m')
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{text} is not a month like 2023-04')
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Update the water meter model with monthly flow data from beacon')
+    parser.add_argument('--start', type=period_arg, help='first month of data to backfill, like 2023-01')
+    parser.add_argument('--end', type=period_arg, help='last month of data to backfill, defaults to the start')
+    args = parser.parse_args(args)
 
     #configure file with login information
     g, b = bapi.config()
-    #collect data
-    data = bapi.monthly_audit(s_time, e_time, g)
-    #update the model on gis with new metering locations if applicable
-    bapi.update_model(data, current_month, g)
-    #average flow data per metering location
-    bapi.averages(g)
+
+    #every beacon and portal call is timed under the stage it happens in, the report is written even if a stage fails
+    try:
+        with profiled():
+            if args.start is not None:
+                #rebuild a range of months, like after the model is reset
+                with metrics.stage('backfill'):
+                    results = backfill(args.start, args.end or args.start, g, b)
+                for month, result in results.items():
+                    metrics.add_result(f'update_model {month}', run_summary(result))
+            else:
+                #the whole month two months ago since that's the last period of full data
+                period = add_months(dt.datetime.now(), -2)
+                with metrics.stage('monthly_update'):
+                    result = run_month(period, g, b)
+                metrics.add_result(f'update_model {period:%Y-%m}', run_summary(result))
+            #average flow data per metering location
+            with metrics.stage('averages'):
+                bapi.averages(g)
+    finally:
+        metrics.write(os.environ.get('WATER_MODEL_REPORT', 'water_model_run.json'))
 
 
 if __name__ == '__main__':